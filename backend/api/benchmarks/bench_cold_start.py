@@ -0,0 +1,104 @@
+"""
+Measure dpa_api's cold start: module import time and the latency of the
+first request through the Lambda handler, each in a fresh interpreter.
+
+    python benchmarks/bench_cold_start.py --runs 10 --max-import-ms 800
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# runs in a fresh interpreter so nothing is already imported or cached
+PROBE = """
+import json, sys, time
+
+start = time.perf_counter()
+import dpa_api
+imported = time.perf_counter()
+
+from botocore.stub import Stubber
+
+event = {
+    "resource": "/{proxy+}",
+    "path": "/pet/SL1",
+    "httpMethod": "GET",
+    "headers": {"Host": "localhost"},
+    "multiValueHeaders": {},
+    "queryStringParameters": None,
+    "multiValueQueryStringParameters": None,
+    "pathParameters": {"proxy": "pet/SL1"},
+    "requestContext": {"resourcePath": "/{proxy+}", "httpMethod": "GET", "stage": "dpa"},
+    "isBase64Encoded": False,
+    "body": None,
+}
+
+with Stubber(dpa_api.get_client()) as stubber:
+    stubber.add_response("get_item", {"Item": {"version": {"N": "1"}}})
+    stubber.add_response("get_item", {"Item": {"id": {"S": "SL1"}}})
+    response = dpa_api.handler(event, None)
+finished = time.perf_counter()
+
+assert response["statusCode"] == 200, response
+print(json.dumps({"import": imported - start, "first_request": finished - imported}))
+"""
+
+
+def run_probe():
+    env = dict(
+        os.environ,
+        PYTHONPATH=SRC,
+        AWS_DEFAULT_REGION="us-east-2",
+        # Lambda provides credentials through the environment
+        AWS_ACCESS_KEY_ID="testing",
+        AWS_SECRET_ACCESS_KEY="testing",
+        PETS_CURSOR_SECRET="benchmark",
+    )
+    output = subprocess.check_output([sys.executable, "-c", PROBE], env=env)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument(
+        "--max-import-ms",
+        type=float,
+        help="exit non-zero if the median import time is above this",
+    )
+    args = parser.parse_args()
+
+    samples = [run_probe() for _ in range(args.runs)]
+    results = {"runs": args.runs}
+    for phase in ("import", "first_request"):
+        timings = sorted(sample[phase] * 1000 for sample in samples)
+        results[phase] = {
+            "min_ms": timings[0],
+            "median_ms": statistics.median(timings),
+            "max_ms": timings[-1],
+        }
+        print(
+            "{:14} min {:7.1f} ms  median {:7.1f} ms  max {:7.1f} ms".format(
+                phase,
+                results[phase]["min_ms"],
+                results[phase]["median_ms"],
+                results[phase]["max_ms"],
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.max_import_ms and results["import"]["median_ms"] > args.max_import_ms:
+        print("import time regression: median above {} ms".format(args.max_import_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
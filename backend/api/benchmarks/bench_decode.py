@@ -0,0 +1,52 @@
+"""
+Compare decode_pet with cerealbox's from_dynamodb_json on synthetic items.
+
+    python benchmarks/bench_decode.py --count 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-2")
+
+from cerealbox.dynamo import from_dynamodb_json  # noqa: E402
+
+import dpa_api  # noqa: E402
+from synthetic import make_pets, to_item  # noqa: E402
+
+
+def best_of(repeat, fn, items):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    items = [to_item(pet) for pet in make_pets(args.count)]
+
+    # both decoders have to agree before their timings mean anything
+    for item in items:
+        assert dpa_api.decode_pet(item) == from_dynamodb_json(item)
+
+    cerealbox_time = best_of(args.repeat, from_dynamodb_json, items)
+    decode_pet_time = best_of(args.repeat, dpa_api.decode_pet, items)
+
+    print("items:             {}".format(args.count))
+    print("from_dynamodb_json {:8.1f} ms".format(cerealbox_time * 1000))
+    print("decode_pet         {:8.1f} ms".format(decode_pet_time * 1000))
+    print("speedup            {:8.1f}x".format(cerealbox_time / decode_pet_time))
+
+
+if __name__ == "__main__":
+    main()
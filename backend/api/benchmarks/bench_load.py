@@ -0,0 +1,210 @@
+"""
+Drive dpa_api.app through the ASGI test client against an in-memory
+DynamoDB and S3 seeded with synthetic pets, and report latency percentiles,
+throughput, peak memory and AWS call counts for each endpoint.
+
+    python benchmarks/bench_load.py --count 1000 --count 10000 --output load.json
+    python benchmarks/bench_load.py --count 100000 --requests 20 --snapshots
+
+Every scenario runs cold (caches cleared before each request, as in a fresh
+container) and warm (caches primed by one request first).
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-2")
+os.environ.setdefault("PETS_CURSOR_SECRET", "benchmark")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import dpa_api  # noqa: E402
+from fake_aws import FakeDynamoDB, FakeS3  # noqa: E402
+from synthetic import make_pets  # noqa: E402
+
+
+def scenarios(pets):
+    ids = [pet["id"] for pet in pets]
+    return [
+        ("list", "/pets"),
+        ("list api_fields", "/pets?api_fields=true"),
+        ("species", "/pets?species=dog"),
+        ("multiple species", "/pets?species=dog,cat"),
+        ("page", "/pets?limit=100"),
+        ("filtered", "/pets?size=small&sex=female"),
+        ("sorted page", "/pets?sort=newest&limit=50"),
+        ("search", "/pets/search?q=playful"),
+        ("facets", "/pets/facets"),
+        ("pet", "/pet/" + ids[len(ids) // 2]),
+        ("batch", "/pets/batch?ids=" + ",".join(ids[:: max(len(ids) // 25, 1)][:25])),
+    ]
+
+
+def seed(pets, snapshots):
+    dynamodb = FakeDynamoDB()
+    for pet in pets:
+        dynamodb.put(dpa_api.table_name, pet)
+
+    version = {"sync-version": "1", "generated-at": str(int(time.time()))}
+    dynamodb.put(dpa_api.meta_table_name, {"id": "catalog", "version": 1})
+    facets = json.dumps(dpa_api.count_facets(pets))
+    dynamodb.put(
+        dpa_api.meta_table_name, {"id": "facets", "facets": facets, "version": 1}
+    )
+
+    s3 = FakeS3()
+    if snapshots:
+        # what pet_sync publishes after a sync
+        bucket = dpa_api.snapshot_bucket
+        views = {None: pets}
+        for pet in pets:
+            views.setdefault(pet["species"], []).append(pet)
+        for species, view in views.items():
+            s3.put_json(bucket, dpa_api.snapshot_key(species, None), view, version)
+            trimmed = [dpa_api.trim_pet(pet, dpa_api.api_fields_keys) for pet in view]
+            key = dpa_api.snapshot_key(species, dpa_api.api_fields_keys)
+            s3.put_json(bucket, key, trimmed, version)
+        index = dpa_api.build_search_index(pets)
+        s3.put_json(bucket, "snapshots/search-index.json.gz", index, version)
+        orderings = dpa_api.build_orderings(pets)
+        s3.put_json(bucket, "snapshots/orderings.json.gz", orderings, version)
+
+    dpa_api._aws_clients.update(dynamodb=dynamodb, s3=s3)
+    return dynamodb, s3
+
+
+def percentile(timings, p):
+    # nearest rank on sorted timings
+    index = max(int(round(p / 100 * len(timings))) - 1, 0)
+    return timings[min(index, len(timings) - 1)]
+
+
+def run_scenario(client, dynamodb, s3, path, requests, cold):
+    if not cold:
+        dpa_api.clear_caches()
+        assert client.get(path).status_code == 200, path
+
+    # memory is measured on a separate request, tracemalloc slows everything
+    if cold:
+        dpa_api.clear_caches()
+    tracemalloc.start()
+    client.get(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    dynamodb.calls.clear()
+    s3.calls.clear()
+    timings = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        if cold:
+            dpa_api.clear_caches()
+        start = time.perf_counter()
+        response = client.get(path)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, (path, response.status_code)
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    calls = dict(dynamodb.calls, **s3.calls)
+    return {
+        "requests": requests,
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "peak_memory_mb": round(peak / 1e6, 2),
+        "response_bytes": len(response.content),
+        "calls_per_request": {
+            operation: count / requests for operation, count in sorted(calls.items())
+        },
+    }
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("ascii").strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, action="append")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument(
+        "--snapshots",
+        action="store_true",
+        help="seed the snapshots pet_sync publishes, not just the table",
+    )
+    parser.add_argument("--accept-encoding", default="identity")
+    parser.add_argument("--scenario", action="append", help="only run these")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "orjson": dpa_api.orjson is not None,
+        "snapshots": args.snapshots,
+        "accept_encoding": args.accept_encoding,
+        "results": [],
+    }
+
+    for count in args.count or [1000, 10000]:
+        pets = make_pets(count)
+        dynamodb, s3 = seed(pets, args.snapshots)
+        client = TestClient(
+            dpa_api.app, headers={"Accept-Encoding": args.accept_encoding}
+        )
+
+        for name, path in scenarios(pets):
+            if args.scenario and name not in args.scenario:
+                continue
+            for cache in ("cold", "warm"):
+                result = run_scenario(
+                    client, dynamodb, s3, path, args.requests, cache == "cold"
+                )
+                results["results"].append(
+                    {
+                        "pets": count,
+                        "scenario": name,
+                        "path": path,
+                        "cache": cache,
+                        **result,
+                    }
+                )
+                print(
+                    "{:>6} {:17} {:4} p50 {:8.2f}  p95 {:8.2f}  p99 {:8.2f} ms"
+                    "  {:8.1f} rps  {:7.2f} MB  {}".format(
+                        count,
+                        name,
+                        cache,
+                        result["p50_ms"],
+                        result["p95_ms"],
+                        result["p99_ms"],
+                        result["throughput_rps"],
+                        result["peak_memory_mb"],
+                        " ".join(
+                            "{}={:g}".format(operation, calls)
+                            for operation, calls in result["calls_per_request"].items()
+                        ),
+                    )
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare the time to render a /pets response body: FastAPI's default
+jsonable_encoder and JSONResponse path against PetsJSONResponse, with orjson
+and with its stdlib json fallback.
+
+    python benchmarks/bench_serialize.py --count 1000 --count 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-2")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import dpa_api  # noqa: E402
+from synthetic import make_pets, to_item  # noqa: E402
+
+
+def fastapi_default(pets):
+    return JSONResponse(jsonable_encoder(pets)).body
+
+
+def pets_json_response(pets):
+    return dpa_api.PetsJSONResponse(pets).body
+
+
+def stdlib_fallback(pets):
+    orjson, dpa_api.orjson = dpa_api.orjson, None
+    try:
+        return dpa_api.PetsJSONResponse(pets).body
+    finally:
+        dpa_api.orjson = orjson
+
+
+def best_of(repeat, fn, pets):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(pets)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, action="append")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    renderers = [
+        ("jsonable_encoder", fastapi_default),
+        ("stdlib json", stdlib_fallback),
+    ]
+    if dpa_api.orjson is not None:
+        renderers.append(("orjson", pets_json_response))
+    else:
+        print("orjson is not installed, only the fallback is measured")
+
+    for count in args.count or [1000, 10000]:
+        # decoded the way the API decodes items read from DynamoDB
+        pets = [dpa_api.decode_pet(to_item(pet)) for pet in make_pets(count)]
+
+        # every renderer has to produce the same document
+        expected = json.loads(fastapi_default(pets))
+        for _, render in renderers:
+            assert json.loads(render(pets)) == expected
+
+        print("pets: {} ({:.1f} MB)".format(count, len(fastapi_default(pets)) / 1e6))
+        baseline = None
+        for name, render in renderers:
+            elapsed = best_of(args.repeat, render, pets)
+            baseline = baseline or elapsed
+            print(
+                "  {:18} {:8.1f} ms {:6.1f}x".format(
+                    name, elapsed * 1000, baseline / elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+In-memory stand-ins for the DynamoDB and S3 clients dpa_api uses, so the
+benchmarks can drive the app against a seeded catalog with no network.
+
+Only the calls and parameters dpa_api makes are implemented. Pages stop at
+Limit or DynamoDB's 1 MB page size, and consumed capacity is estimated from
+item sizes the way DynamoDB bills eventually consistent reads.
+"""
+import gzip
+import io
+import json
+import math
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import botocore.exceptions
+from cerealbox.dynamo import as_dynamodb_json
+
+page_size_bytes = 1024 * 1024
+
+
+def read_units(size: int) -> float:
+    return math.ceil(max(size, 1) / 4096) * 0.5
+
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.tables: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.sizes: Dict[str, int] = {}
+        self.calls: Counter = Counter()
+        self._views: Dict[Tuple[Any, ...], Tuple[List[str], Dict[str, int]]] = {}
+        self._lock = threading.Lock()
+
+    def put(self, table: str, item: Dict[str, Any]) -> None:
+        encoded = as_dynamodb_json(item)["M"]
+        self.tables.setdefault(table, {})[item["id"]] = encoded
+        self.sizes[item["id"]] = len(json.dumps(encoded))
+        self._views.clear()
+
+    def count(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] += 1
+
+    def get_item(self, TableName, Key, ReturnConsumedCapacity=None, **kwargs):
+        self.count("get_item")
+        item = self.tables.get(TableName, {}).get(Key["id"]["S"])
+
+        response = {}
+        if item is not None:
+            response["Item"] = project(item, kwargs)
+        if ReturnConsumedCapacity:
+            size = self.sizes.get(Key["id"]["S"], 0) if item else 0
+            response["ConsumedCapacity"] = {
+                "TableName": TableName,
+                "CapacityUnits": read_units(size),
+            }
+        return response
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity=None):
+        self.count("batch_get_item")
+        responses = {}
+        consumed = []
+        for table, request in RequestItems.items():
+            items = self.tables.get(table, {})
+            found = [
+                items[key["id"]["S"]]
+                for key in request["Keys"]
+                if key["id"]["S"] in items
+            ]
+            responses[table] = [project(item, request) for item in found]
+            size = sum(self.sizes[item["id"]["S"]] for item in found)
+            consumed.append({"TableName": table, "CapacityUnits": read_units(size)})
+
+        response = {"Responses": responses, "UnprocessedKeys": {}}
+        if ReturnConsumedCapacity:
+            response["ConsumedCapacity"] = consumed
+        return response
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, **kwargs):
+        self.count("scan")
+        view = self._view(TableName, ("scan", Segment, TotalSegments))
+        return self._page(TableName, view, kwargs)
+
+    def query(self, TableName, IndexName, ExpressionAttributeValues, **kwargs):
+        self.count("query")
+        assert IndexName == "SpeciesIndex", IndexName
+        species = ExpressionAttributeValues[":species"]["S"]
+        view = self._view(TableName, ("species", species))
+        return self._page(TableName, view, kwargs)
+
+    def _view(self, table: str, key: Tuple[Any, ...]):
+        with self._lock:
+            view = self._views.get((table,) + key)
+            if view is None:
+                items = self.tables.get(table, {})
+                if key[0] == "scan":
+                    _, segment, total = key
+                    ids = [id for i, id in enumerate(items) if i % total == segment]
+                else:
+                    ids = [
+                        id
+                        for id, item in items.items()
+                        if item.get("species", {}).get("S") == key[1]
+                    ]
+                view = (ids, {id: position for position, id in enumerate(ids)})
+                self._views[(table,) + key] = view
+            return view
+
+    def _page(self, table: str, view, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        ids, positions = view
+        start = 0
+        start_key = kwargs.get("ExclusiveStartKey")
+        if start_key:
+            start = positions[start_key["id"]["S"]] + 1
+
+        limit = kwargs.get("Limit") or len(ids)
+        items = self.tables[table] if ids else {}
+        page: List[Dict[str, Any]] = []
+        size = 0
+        position = start
+        while position < len(ids) and len(page) < limit and size < page_size_bytes:
+            page.append(project(items[ids[position]], kwargs))
+            size += self.sizes[ids[position]]
+            position += 1
+
+        response: Dict[str, Any] = {"Items": page, "Count": len(page)}
+        if position < len(ids):
+            response["LastEvaluatedKey"] = {"id": {"S": ids[position - 1]}}
+        if kwargs.get("ReturnConsumedCapacity"):
+            response["ConsumedCapacity"] = {
+                "TableName": table,
+                "CapacityUnits": read_units(size),
+            }
+        return response
+
+
+def project(item: Dict[str, Any], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    expression = kwargs.get("ProjectionExpression")
+    if not expression:
+        return item
+
+    names = kwargs.get("ExpressionAttributeNames", {})
+    attributes = [
+        names.get(name.strip(), name.strip()) for name in expression.split(",")
+    ]
+    return {name: item[name] for name in attributes if name in item}
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects: Dict[Tuple[str, str], Tuple[bytes, Dict[str, str]]] = {}
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def put_json(
+        self, bucket: str, key: str, data: Any, metadata: Dict[str, str]
+    ) -> None:
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        self.objects[(bucket, key)] = (gzip.compress(body, mtime=0), metadata)
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["get_object"] += 1
+
+        stored: Optional[Tuple[bytes, Dict[str, str]]] = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject"
+            )
+
+        body, metadata = stored
+        return {"Body": io.BytesIO(body), "Metadata": dict(metadata)}
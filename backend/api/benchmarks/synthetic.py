@@ -0,0 +1,65 @@
+"""
+Synthetic pets shaped like the records parse_shelterluv_pets and
+parse_new_digs_pets write to the Pets table, for the benchmarks.
+"""
+import random
+from typing import Any, Dict, List
+
+from cerealbox.dynamo import as_dynamodb_json
+
+SPECIES = ["dog", "dog", "dog", "cat", "cat", "rabbit", "pig"]
+SEXES = ["Male", "Female"]
+AGES = ["Baby", "Young", "Adult", "Senior"]
+SIZES = ["Small", "Medium", "Large", "Extra-Large", None]
+BREEDS = ["Beagle", "Labrador Retriever", "Domestic Shorthair", "Tabby", "Mix"]
+COLORS = ["Black", "White", "Brown", "Tan", "Brindle", "Orange"]
+LOCATIONS = [
+    "DPA! Foster Home",
+    "Humane Society of Dallas County",
+    "New Digs Owner's Home",
+]
+WORDS = (
+    "sweet playful housetrained crate trained loves walks gentle shy cuddly "
+    "good with kids dogs cats energetic calm leash fetch treats lap couch"
+).split()
+
+
+def make_pet(index: int, rng: random.Random) -> Dict[str, Any]:
+    source = "shelterluv" if index % 4 else "airtable"
+    prefix = "SL" if source == "shelterluv" else "AT"
+    internal_id = str(100000 + index)
+    photo_base = "https://www.shelterluv.com/sites/default/files/animal_pics/3451/"
+
+    return {
+        "id": prefix + internal_id,
+        "internalId": internal_id,
+        "name": "Pet {}".format(index),
+        "species": rng.choice(SPECIES),
+        "sex": rng.choice(SEXES),
+        "age": rng.choice(AGES),
+        "breed": rng.choice(BREEDS),
+        "color": rng.choice(COLORS),
+        "description": " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 160))),
+        "size": rng.choice(SIZES),
+        "coverPhoto": photo_base + "{}-0.png".format(index),
+        "photos": [
+            photo_base + "{}-{}.png".format(index, n) for n in range(rng.randint(1, 8))
+        ],
+        "video": rng.choice([None, "https://youtu.be/{}".format(index)]),
+        "status": "adoptable",
+        "source": source,
+        "adoptLink": "https://www.shelterluv.com/matchme/adopt/DPA-A-" + internal_id,
+        "location": rng.choice(LOCATIONS),
+        "firstSeen": "2024-{:02d}-{:02d}T12:00:00Z".format(
+            rng.randint(1, 12), rng.randint(1, 28)
+        ),
+    }
+
+
+def make_pets(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    return [make_pet(index, rng) for index in range(count)]
+
+
+def to_item(pet: Dict[str, Any]) -> Dict[str, Any]:
+    return as_dynamodb_json(pet)["M"]
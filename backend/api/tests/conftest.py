@@ -0,0 +1,10 @@
+import pytest
+
+import dpa_api
+
+
+@pytest.fixture(autouse=True)
+def reset_caches():
+    dpa_api.clear_caches()
+    yield
+    dpa_api.clear_caches()
@@ -1,9 +1,65 @@
 from botocore.stub import Stubber
 
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+from botocore.response import StreamingBody
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from starlette.middleware.base import BaseHTTPMiddleware
+
 import dpa_api
 
+
+def add_version_response(stubber, version="1"):
+    stubber.add_response(
+        "get_item",
+        {"Item": {"version": {"N": version}}},
+        {
+            "TableName": dpa_api.meta_table_name,
+            "Key": {"id": {"S": "catalog"}},
+            "ProjectionExpression": "version, etag",
+        },
+    )
+
+
+def add_snapshot_missing(s3_stubber, key="snapshots/pets.json.gz"):
+    s3_stubber.add_client_error(
+        "get_object",
+        service_error_code="NoSuchKey",
+        http_status_code=404,
+        expected_params={"Bucket": dpa_api.snapshot_bucket, "Key": key},
+    )
+
+
+def add_snapshot_response(s3_stubber, key, data, version="1", generated_at=None):
+    body = gzip.compress(json.dumps(data).encode("utf-8"))
+    if generated_at is None:
+        generated_at = int(time.time())
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": StreamingBody(io.BytesIO(body), len(body)),
+            "Metadata": {
+                "sync-version": version,
+                "generated-at": str(generated_at),
+            },
+        },
+        {"Bucket": dpa_api.snapshot_bucket, "Key": key},
+    )
+
+
 def test_get_pet():
     with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
         # Set up a stubbed response
         response = {
             "Item": {
@@ -16,12 +72,12 @@ def test_get_pet():
         }
         expected_params = {
             "TableName": dpa_api.table_name,
-            "Key": {"petId": {"N": "1"}},
+            "Key": {"id": {"S": "1"}},
         }
         stubber.add_response("get_item", response, expected_params)
 
         # Call the service, which will send the request to the mocked instance
-        response = dpa_api.get_pet(1)
+        response = dpa_api.get_pet("1")
 
         # If no error is raised, then assertion passes
         assert response == {
@@ -36,7 +92,10 @@ def test_get_pet():
 
 
 def test_list_pets():
-    with Stubber(dpa_api.client) as stubber:
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_missing(s3_stubber)
+
         # Set up a stubbed response
         response = {
             "Items": [
@@ -84,7 +143,10 @@ def test_list_pets():
 
 
 def test_list_pets_species():
-    with Stubber(dpa_api.client) as stubber:
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_missing(s3_stubber, "snapshots/species/Dog.json.gz")
+
         # Set up a stubbed response
         response = {
             "Items": [
@@ -134,3 +196,1094 @@ def test_list_pets_species():
         ]
 
         stubber.assert_no_pending_responses()
+
+
+def test_list_pets_cached():
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_missing(s3_stubber)
+        response = {
+            "Items": [
+                {
+                    "id": {"S": "1"},
+                    "name": {"S": "Fido"},
+                    "species": {"S": "Dog"},
+                },
+            ]
+        }
+        stubber.add_response("scan", response, {"TableName": dpa_api.table_name})
+
+        first = dpa_api.get_pets()
+        # served from the cache, no further DynamoDB calls are stubbed
+        second = dpa_api.get_pets()
+
+        assert first == second == [{"id": "1", "name": "Fido", "species": "Dog"}]
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_cache_invalidated_by_sync_version(monkeypatch):
+    monkeypatch.setattr(dpa_api, "version_check_seconds", 0)
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber, "1")
+        add_snapshot_missing(s3_stubber)
+        stubber.add_response(
+            "scan",
+            {"Items": [{"id": {"S": "1"}, "name": {"S": "Fido"}}]},
+            {"TableName": dpa_api.table_name},
+        )
+        add_version_response(stubber, "2")
+        add_snapshot_missing(s3_stubber)
+        stubber.add_response(
+            "scan",
+            {"Items": [{"id": {"S": "2"}, "name": {"S": "Garfield"}}]},
+            {"TableName": dpa_api.table_name},
+        )
+
+        assert dpa_api.get_pets() == [{"id": "1", "name": "Fido"}]
+        assert dpa_api.get_pets() == [{"id": "2", "name": "Garfield"}]
+
+        stubber.assert_no_pending_responses()
+
+
+def test_get_pet_not_found_cached():
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        expected_params = {
+            "TableName": dpa_api.table_name,
+            "Key": {"id": {"S": "5"}},
+        }
+        stubber.add_response("get_item", {}, expected_params)
+
+        for _ in range(2):
+            with pytest.raises(HTTPException) as excinfo:
+                dpa_api.get_pet("5")
+            assert excinfo.value.status_code == 404
+
+        stubber.assert_no_pending_responses()
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = dpa_api.TTLCache(max_entries=2, ttl=60)
+    cache.put("a", 1, "v1")
+    cache.put("b", 2, "v1")
+    assert cache.get("a", "v1") == 1
+
+    cache.put("c", 3, "v1")
+
+    assert cache.get("b", "v1") is dpa_api._MISSING
+    assert cache.get("a", "v1") == 1
+    assert cache.get("c", "v1") == 3
+    assert cache.get("c", "v2") is dpa_api._MISSING
+
+
+def test_list_pets_from_snapshot():
+    pets = [{"id": "AT1", "name": "Fido", "species": "dog"}]
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber, "3")
+        add_snapshot_response(
+            s3_stubber, "snapshots/species/dog-api-fields.json.gz", pets, "3"
+        )
+
+        assert dpa_api.get_pets("dog", True) == pets
+
+        stubber.assert_no_pending_responses()
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_list_pets_stale_snapshot():
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber, "4")
+        add_snapshot_response(
+            s3_stubber, "snapshots/pets.json.gz", [{"id": "old"}], "3"
+        )
+        stubber.add_response(
+            "scan",
+            {"Items": [{"id": {"S": "new"}}]},
+            {"TableName": dpa_api.table_name},
+        )
+
+        assert dpa_api.get_pets() == [{"id": "new"}]
+
+        stubber.assert_no_pending_responses()
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_snapshot_expires_without_sync_version():
+    with Stubber(dpa_api.s3_client) as s3_stubber:
+        add_snapshot_response(
+            s3_stubber, "snapshots/pets.json.gz", [{"id": "1"}], "1", generated_at=0
+        )
+
+        assert dpa_api.read_snapshot(None, False, None) is None
+
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_scan_table_segments(monkeypatch):
+    # a single worker keeps the stubbed responses in segment order
+    monkeypatch.setattr(dpa_api, "scan_max_workers", 1)
+
+    with Stubber(dpa_api.client) as stubber:
+        for segment in range(3):
+            stubber.add_response(
+                "scan",
+                {"Items": [{"id": {"S": str(segment)}}]},
+                {
+                    "TableName": dpa_api.table_name,
+                    "Segment": segment,
+                    "TotalSegments": 3,
+                },
+            )
+
+        items = dpa_api.scan_table(3, TableName=dpa_api.table_name)
+
+        assert items == [{"id": {"S": "0"}}, {"id": {"S": "1"}}, {"id": {"S": "2"}}]
+
+        stubber.assert_no_pending_responses()
+
+
+def test_scan_table_segment_without_items(monkeypatch):
+    monkeypatch.setattr(dpa_api, "scan_max_workers", 1)
+
+    with Stubber(dpa_api.client) as stubber:
+        stubber.add_response("scan", {"Items": []})
+        stubber.add_response("scan", {})
+
+        assert dpa_api.scan_table(2, TableName=dpa_api.table_name) is None
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_fields_projection():
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_missing(s3_stubber, "snapshots/species/dog.json.gz")
+        expected_params = {
+            "TableName": dpa_api.table_name,
+            "IndexName": "SpeciesIndex",
+            "KeyConditionExpression": "species = :species",
+            "ExpressionAttributeValues": {":species": {"S": "dog"}},
+            "ProjectionExpression": "#f0, #f1",
+            "ExpressionAttributeNames": {"#f0": "id", "#f1": "size"},
+        }
+        stubber.add_response(
+            "query",
+            {
+                "Items": [
+                    {"id": {"S": "AT1"}},
+                    {"id": {"S": "AT2"}, "size": {"S": "Small"}},
+                ]
+            },
+            expected_params,
+        )
+
+        assert dpa_api.get_pets("dog", fields="id, size,id") == [
+            {"id": "AT1", "size": None},
+            {"id": "AT2", "size": "Small"},
+        ]
+
+        stubber.assert_no_pending_responses()
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_list_pets_fields_from_snapshot():
+    pets = [{"id": "AT1", "name": "Fido", "description": "A good dog"}]
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_response(s3_stubber, "snapshots/pets.json.gz", pets)
+
+        assert dpa_api.get_pets(fields="name") == [{"name": "Fido"}]
+
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_get_pet_fields_projection():
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        expected_params = {
+            "TableName": dpa_api.table_name,
+            "Key": {"id": {"S": "1"}},
+            "ProjectionExpression": "#f0",
+            "ExpressionAttributeNames": {"#f0": "name"},
+        }
+        stubber.add_response(
+            "get_item", {"Item": {"name": {"S": "Fido"}}}, expected_params
+        )
+
+        assert dpa_api.get_pet("1", fields="name") == {"name": "Fido"}
+
+        stubber.assert_no_pending_responses()
+
+
+def test_first_seen_field():
+    assert dpa_api.parse_fields("id,firstSeen") == ("id", "firstSeen")
+
+
+def test_parse_fields_skips_empty_names():
+    assert dpa_api.parse_fields("name,") == ("name",)
+    assert dpa_api.parse_fields(" , ") is None
+
+
+def test_unknown_fields():
+    with pytest.raises(HTTPException) as excinfo:
+        dpa_api.get_pets(fields="name,favoriteToy")
+
+    assert excinfo.value.status_code == 400
+
+
+def test_list_pets_paginated():
+    last_key = {"id": {"S": "2"}, "species": {"S": "dog"}}
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        query_params = {
+            "TableName": dpa_api.table_name,
+            "IndexName": "SpeciesIndex",
+            "KeyConditionExpression": "species = :species",
+            "ExpressionAttributeValues": {":species": {"S": "dog"}},
+            "Limit": 2,
+        }
+        stubber.add_response(
+            "query",
+            {
+                "Items": [{"id": {"S": "1"}}, {"id": {"S": "2"}}],
+                "LastEvaluatedKey": last_key,
+            },
+            query_params,
+        )
+        stubber.add_response(
+            "query",
+            {"Items": [{"id": {"S": "3"}}]},
+            dict(query_params, ExclusiveStartKey=last_key),
+        )
+
+        first = dpa_api.get_pets("dog", limit=2)
+        assert first["pets"] == [{"id": "1"}, {"id": "2"}]
+        assert first["next_cursor"]
+
+        second = dpa_api.get_pets("dog", limit=2, cursor=first["next_cursor"])
+        assert second == {"pets": [{"id": "3"}], "next_cursor": None}
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_cursor_rejected():
+    cursor = dpa_api.encode_cursor({"k": {"id": {"S": "2"}}, "s": "dog"})
+    signature = cursor.split(".")[1]
+    tampered = dpa_api.encode_cursor({"k": {"id": {"S": "9"}}, "s": "dog"})
+
+    for bad_cursor, species in [
+        (tampered.split(".")[0] + "." + signature, "dog"),
+        (cursor, "cat"),
+        ("not-a-cursor", "dog"),
+    ]:
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets(species, cursor=bad_cursor)
+        assert excinfo.value.status_code == 400
+
+
+def test_list_pets_limit_out_of_range():
+    with pytest.raises(HTTPException) as excinfo:
+        dpa_api.get_pets(limit=dpa_api.max_page_size + 1)
+
+    assert excinfo.value.status_code == 400
+
+    with pytest.raises(HTTPException) as excinfo:
+        dpa_api.get_pets(limit=0)
+
+    assert excinfo.value.status_code == 400
+
+
+def test_pages_dont_evict_the_catalog(monkeypatch):
+    monkeypatch.setattr(dpa_api, "get_sync_version", lambda: "1")
+    monkeypatch.setattr(
+        dpa_api,
+        "query_pets_page",
+        lambda species, fields, limit, start_key: {"pets": [], "cursor": None},
+    )
+    catalog = [{"id": "1"}]
+    dpa_api.catalog_cache.put((None, None), catalog, "1")
+
+    # a client walking more pages than any cache holds
+    for limit in range(1, dpa_api.page_cache_max_entries + 10):
+        dpa_api.get_pets_page(None, None, limit, None)
+
+    assert dpa_api.catalog_cache.get((None, None), "1") is catalog
+
+
+def test_list_pets_ndjson():
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        last_key = {"id": {"S": "1"}}
+        stubber.add_response(
+            "scan",
+            {
+                "Items": [{"id": {"S": "1"}, "age": {"N": "2"}}],
+                "LastEvaluatedKey": last_key,
+            },
+            {"TableName": dpa_api.table_name},
+        )
+        stubber.add_response(
+            "scan",
+            {"Items": [{"id": {"S": "2"}, "weight": {"N": "4.5"}}]},
+            {"TableName": dpa_api.table_name, "ExclusiveStartKey": last_key},
+        )
+
+        response = TestClient(dpa_api.app).get("/pets?format=ndjson")
+
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert response.content == (b'{"id":"1","age":2}\n{"id":"2","weight":4.5}\n')
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_ndjson_from_cache():
+    dpa_api.catalog_cache.put((None, None), [{"id": "1"}], "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        response = TestClient(dpa_api.app).get("/pets?format=ndjson")
+
+        assert response.content == b'{"id":"1"}\n'
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_bad_format():
+    for kwargs in [{"format": "xml"}, {"format": "ndjson", "limit": 10}]:
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets(**kwargs)
+        assert excinfo.value.status_code == 400
+
+
+def add_catalog_state_response(stubber, version="1", etag="abc"):
+    stubber.add_response(
+        "get_item",
+        {"Item": {"version": {"N": version}, "etag": {"S": etag}}},
+        {
+            "TableName": dpa_api.meta_table_name,
+            "Key": {"id": {"S": "catalog"}},
+            "ProjectionExpression": "version, etag",
+        },
+    )
+
+
+def test_list_pets_etag():
+    dpa_api.pets_cache.put(("dog", None), [{"id": "1"}], "1")
+    dpa_api.pets_cache.put(("dog", dpa_api.api_fields_keys), [{"id": "1"}], "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_catalog_state_response(stubber)
+        client = TestClient(dpa_api.app, headers={"Accept-Encoding": "identity"})
+
+        response = client.get("/pets?species=dog")
+        assert response.status_code == 200
+        assert response.json() == [{"id": "1"}]
+        etag = response.headers["etag"]
+        assert response.headers["cache-control"] == dpa_api.cache_control
+
+        # a different query gets a different tag
+        other = client.get(
+            "/pets?species=dog&api_fields=true", headers={"If-None-Match": etag}
+        )
+        assert other.status_code == 200
+        assert other.headers["etag"] != etag
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_not_modified():
+    digest = hashlib.sha256(b"abc|/pets?species=dog|gzip").hexdigest()[:32]
+    etag = 'W/"' + digest + '"'
+
+    with Stubber(dpa_api.client) as stubber:
+        add_catalog_state_response(stubber, etag="abc")
+
+        # a client may send the tag back without its weak prefix
+        response = TestClient(dpa_api.app).get(
+            "/pets?species=dog",
+            headers={
+                "If-None-Match": 'W/"old", "' + digest + '"',
+                "Accept-Encoding": "gzip",
+            },
+        )
+
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+        assert response.content == b""
+
+        # no scan, query or snapshot read was needed
+        stubber.assert_no_pending_responses()
+
+
+def test_if_none_match_any():
+    client = TestClient(dpa_api.app)
+    headers = {"If-None-Match": "*", "Accept-Encoding": "identity"}
+
+    with Stubber(dpa_api.client) as stubber:
+        add_catalog_state_response(stubber, etag="abc")
+        stubber.add_response(
+            "get_item",
+            {},
+            {"TableName": dpa_api.table_name, "Key": {"id": {"S": "missing"}}},
+        )
+
+        # nothing exists to match
+        assert client.get("/pet/missing", headers=headers).status_code == 404
+
+        dpa_api.catalog_cache.put((None, None), [{"id": "1"}], "1")
+        response = client.get("/pets", headers=headers)
+        assert response.status_code == 304
+        assert response.content == b""
+
+        stubber.assert_no_pending_responses()
+
+
+def test_no_etag_without_catalog_hash():
+    dpa_api.catalog_cache.put((None, None), [], "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        response = TestClient(dpa_api.app).get(
+            "/pets", headers={"Accept-Encoding": "identity"}
+        )
+
+        assert response.status_code == 200
+        assert "etag" not in response.headers
+
+        stubber.assert_no_pending_responses()
+
+
+def test_decode_pet_matches_cerealbox():
+    from cerealbox.dynamo import from_dynamodb_json
+
+    item = {
+        "id": {"S": "SL1"},
+        "photos": {"L": [{"S": "a.png"}, {"S": "b.png"}]},
+        "video": {"NULL": True},
+        "age": {"N": "2"},
+        "tags": {"L": [{"S": "a"}, {"N": "1"}]},
+        "extra": {"M": {"housetrained": {"BOOL": True}}},
+    }
+
+    assert dpa_api.decode_pet(item) == from_dynamodb_json(item)
+
+    # photos that aren't plain strings fall back to the generic decoder
+    item["photos"] = {"L": [{"M": {"url": {"S": "a.png"}}}]}
+    assert dpa_api.decode_pet(item) == from_dynamodb_json(item)
+
+
+def test_decode_pet_drops_content_hash():
+    item = {"id": {"S": "SL1"}, "contentHash": {"S": "abc"}}
+
+    assert dpa_api.decode_pet(item) == {"id": "SL1"}
+
+
+def test_get_pets_batch(monkeypatch):
+    monkeypatch.setattr(dpa_api, "batch_get_chunk_size", 2)
+    monkeypatch.setattr(dpa_api, "batch_get_backoff_seconds", 0)
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        stubber.add_response(
+            "batch_get_item",
+            {
+                "Responses": {
+                    "Pets": [{"id": {"S": "SL2"}, "name": {"S": "Socks"}}],
+                },
+                "UnprocessedKeys": {"Pets": {"Keys": [{"id": {"S": "SL1"}}]}},
+            },
+            {
+                "RequestItems": {
+                    "Pets": {"Keys": [{"id": {"S": "SL1"}}, {"id": {"S": "SL2"}}]}
+                }
+            },
+        )
+        stubber.add_response(
+            "batch_get_item",
+            {"Responses": {"Pets": [{"id": {"S": "SL1"}, "name": {"S": "Fido"}}]}},
+            {"RequestItems": {"Pets": {"Keys": [{"id": {"S": "SL1"}}]}}},
+        )
+        stubber.add_response(
+            "batch_get_item",
+            {"Responses": {"Pets": []}},
+            {"RequestItems": {"Pets": {"Keys": [{"id": {"S": "AT9"}}]}}},
+        )
+
+        response = dpa_api.get_pets_batch("SL1, SL2,AT9,SL1")
+
+        assert response == {
+            "pets": [
+                {"id": "SL1", "name": "Fido"},
+                {"id": "SL2", "name": "Socks"},
+                None,
+            ],
+            "not_found": ["AT9"],
+        }
+
+        # everything, including the miss, is now cached
+        assert dpa_api.get_pets_batch("AT9,SL2") == {
+            "pets": [None, {"id": "SL2", "name": "Socks"}],
+            "not_found": ["AT9"],
+        }
+
+        stubber.assert_no_pending_responses()
+
+
+def test_get_pets_batch_fields_projects_id():
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        stubber.add_response(
+            "batch_get_item",
+            {"Responses": {"Pets": [{"id": {"S": "SL1"}, "name": {"S": "Fido"}}]}},
+            {
+                "RequestItems": {
+                    "Pets": {
+                        "Keys": [{"id": {"S": "SL1"}}],
+                        "ProjectionExpression": "#f0, #f1",
+                        "ExpressionAttributeNames": {"#f0": "name", "#f1": "id"},
+                    }
+                }
+            },
+        )
+
+        assert dpa_api.get_pets_batch("SL1", fields="name") == {
+            "pets": [{"name": "Fido"}],
+            "not_found": [],
+        }
+
+        stubber.assert_no_pending_responses()
+
+
+def test_get_pets_batch_gives_up(monkeypatch):
+    monkeypatch.setattr(dpa_api, "batch_get_max_attempts", 2)
+    monkeypatch.setattr(dpa_api, "batch_get_backoff_seconds", 0)
+
+    unprocessed = {"Pets": {"Keys": [{"id": {"S": "SL1"}}]}}
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        for _ in range(2):
+            stubber.add_response(
+                "batch_get_item",
+                {"Responses": {"Pets": []}, "UnprocessedKeys": unprocessed},
+            )
+
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets_batch("SL1")
+        assert excinfo.value.status_code == 503
+
+        stubber.assert_no_pending_responses()
+
+
+def test_get_pets_batch_bad_ids():
+    for ids in [" , ", ",".join(str(n) for n in range(dpa_api.batch_get_max_ids + 1))]:
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets_batch(ids)
+        assert excinfo.value.status_code == 400
+
+
+def test_aws_clients_are_shared():
+    assert dpa_api.client is dpa_api.get_client()
+    assert dpa_api.s3_client is dpa_api.get_aws_client("s3")
+
+    loader = dpa_api._aws_session.get_component("data_loader")
+    assert loader.list_available_services("service-2") == list(dpa_api.aws_services)
+
+
+catalog = [
+    {"id": "SL1", "species": "dog", "size": "Small", "age": "Young", "sex": "Male"},
+    {"id": "SL2", "species": "dog", "size": "Large", "age": "Young", "sex": "Female"},
+    {"id": "SL3", "species": "cat", "size": "Small", "age": "Baby", "sex": "Female"},
+    {"id": "AT4", "species": "dog", "size": "Small", "age": "Baby", "sex": "Female"},
+    {"id": "AT5", "species": "dog", "size": None, "age": "Senior", "sex": "Male"},
+]
+
+
+def test_list_pets_filtered():
+    dpa_api.catalog_cache.put((None, None), catalog, "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        pets = dpa_api.get_pets("dog", size="small", age="Young,baby")
+        assert [pet["id"] for pet in pets] == ["SL1", "AT4"]
+
+        pets = dpa_api.get_pets(sex="female", api_fields=True)
+        assert pets == [
+            dpa_api.trim_pet(pet, dpa_api.api_fields_keys)
+            for pet in catalog
+            if pet["sex"] == "Female"
+        ]
+
+        assert dpa_api.get_pets(size="medium") == []
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_filtered_paginated():
+    dpa_api.catalog_cache.put((None, None), catalog, "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        first = dpa_api.get_pets(size="small", limit=2)
+        assert [pet["id"] for pet in first["pets"]] == ["SL1", "SL3"]
+
+        second = dpa_api.get_pets(size="small", limit=2, cursor=first["next_cursor"])
+        assert second == {"pets": [catalog[3]], "next_cursor": None}
+
+        # the cursor is bound to the filters it was issued for
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets(size="large", limit=2, cursor=first["next_cursor"])
+        assert excinfo.value.status_code == 400
+
+        stubber.assert_no_pending_responses()
+
+
+def test_pet_index_rebuilt_for_new_listing():
+    dpa_api.catalog_cache.put((None, None), catalog, "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        index = dpa_api.get_pet_index()
+        assert dpa_api.get_pet_index() is index
+
+        dpa_api.catalog_cache.put((None, None), catalog[:1], "1")
+        assert dpa_api.get_pet_index() is not index
+        assert dpa_api.get_pets(sex="male") == [catalog[0]]
+
+
+search_catalog = [
+    {"id": "SL1", "name": "Biscuit", "breed": "Beagle", "color": "Tan"},
+    {
+        "id": "SL2",
+        "name": "Beagle Bailey",
+        "breed": "Beagle",
+        "description": "Housetrained",
+    },
+    {"id": "AT3", "name": "Housey", "breed": "Labrador", "description": "Trained"},
+    {"id": "AT4", "name": "Pepper", "breed": "Mix", "description": "Loves puppies"},
+]
+
+
+def test_search_pets():
+    dpa_api.catalog_cache.put((None, None), search_catalog, "1")
+    index = dpa_api.build_search_index(search_catalog)
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_response(s3_stubber, "snapshots/search-index.json.gz", index)
+
+        # name matches outrank breed matches
+        response = dpa_api.search_pets("beagles")
+        assert [pet["id"] for pet in response["pets"]] == ["SL2", "SL1"]
+
+        # every word must match, the last one may be a prefix
+        response = dpa_api.search_pets("beagle housetr", fields="name")
+        assert response == {"pets": [{"name": "Beagle Bailey"}], "next_cursor": None}
+
+        response = dpa_api.search_pets("puppy")
+        assert [pet["id"] for pet in response["pets"]] == ["AT4"]
+
+        assert dpa_api.search_pets("the")["pets"] == []
+        assert dpa_api.search_pets("unicorn")["pets"] == []
+
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_search_pets_paginated_without_published_index():
+    dpa_api.catalog_cache.put((None, None), search_catalog, "1")
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_missing(s3_stubber, "snapshots/search-index.json.gz")
+
+        # "bea" prefixes beagle
+        first = dpa_api.search_pets("bea", limit=1)
+        assert len(first["pets"]) == 1
+        second = dpa_api.search_pets("bea", limit=1, cursor=first["next_cursor"])
+        assert second["next_cursor"] is None
+
+        ids = [pet["id"] for pet in first["pets"] + second["pets"]]
+        assert sorted(ids) == ["SL1", "SL2"]
+
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_get_facets():
+    facets = dpa_api.count_facets(catalog)
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        stubber.add_response(
+            "get_item",
+            {
+                "Item": {
+                    "id": {"S": "facets"},
+                    "facets": {"S": json.dumps(facets)},
+                    "version": {"N": "1"},
+                }
+            },
+            {"TableName": dpa_api.meta_table_name, "Key": {"id": {"S": "facets"}}},
+        )
+
+        response = dpa_api.get_facets()
+        assert response["total"] == 5
+        assert response["facets"]["species"] == {"dog": 4, "cat": 1}
+        assert response["facets"]["size"] == {"Small": 3, "Large": 1}
+
+        # served from the cache for the rest of the version
+        response = dpa_api.get_facets("Dog")
+        assert response == {
+            "total": 4,
+            "facets": {
+                "size": {"Small": 2, "Large": 1},
+                "age": {"Young": 2, "Baby": 1, "Senior": 1},
+                "sex": {"Male": 2, "Female": 2},
+            },
+        }
+
+        assert dpa_api.get_facets("bird") == {"total": 0, "facets": {}}
+
+        stubber.assert_no_pending_responses()
+
+
+def test_get_facets_stale_document():
+    dpa_api.catalog_cache.put((None, None), catalog, "2")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber, "2")
+        stubber.add_response(
+            "get_item",
+            {
+                "Item": {
+                    "id": {"S": "facets"},
+                    "facets": {"S": json.dumps({"all": {}, "species": {}})},
+                    "version": {"N": "1"},
+                }
+            },
+            {"TableName": dpa_api.meta_table_name, "Key": {"id": {"S": "facets"}}},
+        )
+
+        response = dpa_api.get_facets("cat")
+        assert response["total"] == 1
+        assert response["facets"]["age"] == {"Baby": 1}
+
+        stubber.assert_no_pending_responses()
+
+
+sorted_catalog = [
+    {"id": "SL1", "name": "Biscuit", "species": "dog", "age": "Adult", "sex": "Male"},
+    {"id": "SL2", "name": "socks", "species": "cat", "age": "Baby", "sex": "Female"},
+    {"id": "AT3", "name": "Apollo", "species": "dog", "age": "Baby", "sex": "Male"},
+    {"id": "AT4", "name": "Zed", "species": "dog", "age": "Senior", "sex": "Female"},
+]
+
+
+def test_list_pets_sorted():
+    dpa_api.catalog_cache.put((None, None), sorted_catalog, "1")
+    orderings = {
+        "newest": ["AT4", "SL2", "AT3", "SL1"],
+        "name": ["AT3", "SL1", "SL2", "AT4"],
+        "age": ["AT3", "SL2", "SL1", "AT4"],
+    }
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_response(s3_stubber, "snapshots/orderings.json.gz", orderings)
+
+        pets = dpa_api.get_pets(sort="newest")
+        assert [pet["id"] for pet in pets] == ["AT4", "SL2", "AT3", "SL1"]
+
+        pets = dpa_api.get_pets("dog", sort="name", fields="name")
+        assert pets == [{"name": "Apollo"}, {"name": "Biscuit"}, {"name": "Zed"}]
+
+        first = dpa_api.get_pets(sort="age", sex="male", limit=1)
+        assert [pet["id"] for pet in first["pets"]] == ["AT3"]
+        second = dpa_api.get_pets(
+            sort="age", sex="male", limit=1, cursor=first["next_cursor"]
+        )
+        assert [pet["id"] for pet in second["pets"]] == ["SL1"]
+        assert second["next_cursor"] is None
+
+        # cursors are bound to the sort order
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets(sex="male", limit=1, cursor=first["next_cursor"])
+        assert excinfo.value.status_code == 400
+
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets(sort="size")
+        assert excinfo.value.status_code == 400
+
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_list_pets_sorted_without_published_orderings():
+    dpa_api.catalog_cache.put((None, None), sorted_catalog, "1")
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_missing(s3_stubber, "snapshots/orderings.json.gz")
+
+        pets = dpa_api.get_pets(sort="name")
+        assert [pet["id"] for pet in pets] == ["AT3", "SL1", "SL2", "AT4"]
+
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_accepted_encodings(monkeypatch):
+    monkeypatch.setattr(dpa_api, "brotli", None)
+    assert dpa_api.accepted_encodings(None) == ()
+    assert dpa_api.accepted_encodings("identity") == ()
+    assert dpa_api.accepted_encodings("br, gzip;q=0.5") == ("gzip",)
+    assert dpa_api.accepted_encodings("gzip;q=0, deflate") == ()
+
+    monkeypatch.setattr(dpa_api, "brotli", object())
+    assert dpa_api.accepted_encodings("gzip, br") == ("br", "gzip")
+    assert dpa_api.accepted_encodings("*") == ("br", "gzip")
+
+
+def test_list_pets_precompressed():
+    pets = [{"id": "1", "name": "Fido", "species": "dog"}]
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_response(s3_stubber, "snapshots/species/dog.json.gz", pets)
+        client = TestClient(dpa_api.app, headers={"Accept-Encoding": "gzip"})
+
+        # the stored bytes are served as they are, with no DynamoDB read
+        response = client.get("/pets?species=dog")
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.json() == pets
+
+        response = client.get("/pets?species=dog")
+        assert response.json() == pets
+
+        stubber.assert_no_pending_responses()
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_list_pets_compressed(monkeypatch):
+    monkeypatch.setattr(dpa_api, "compress_min_bytes", 0)
+    dpa_api.catalog_cache.put((None, None), catalog, "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        client = TestClient(dpa_api.app, headers={"Accept-Encoding": "gzip"})
+
+        # filtered views aren't published, so they are compressed per request
+        response = client.get("/pets?size=large")
+        assert response.headers["content-encoding"] == "gzip"
+        assert [pet["id"] for pet in response.json()] == ["SL2"]
+
+        # errors are passed through untouched
+        response = client.get("/pets?sort=size")
+        assert response.status_code == 400
+        assert "content-encoding" not in response.headers
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_json(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(dpa_api, "orjson", None)
+
+    pet = {"id": "SL1", "name": "Zoë", "age": Decimal("2"), "weight": Decimal("4.5")}
+    assert dpa_api.dumps_json(pet) == (
+        '{"id":"SL1","name":"Zoë","age":2,"weight":4.5}'.encode("utf-8")
+    )
+
+    with pytest.raises(TypeError):
+        dpa_api.dumps_json({"when": object()})
+
+
+def test_routes_skip_jsonable_encoder(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("jsonable_encoder was called")
+
+    monkeypatch.setattr("fastapi.routing.jsonable_encoder", fail)
+    dpa_api.catalog_cache.put((None, None), [{"id": "1", "age": Decimal("2")}], "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        response = TestClient(dpa_api.app).get(
+            "/pets", headers={"Accept-Encoding": "identity"}
+        )
+
+        assert response.headers["content-type"] == "application/json"
+        assert response.json() == [{"id": "1", "age": 2}]
+
+        stubber.assert_no_pending_responses()
+
+
+def test_list_pets_multiple_species(monkeypatch):
+    # one worker keeps the stubbed calls in a predictable order
+    monkeypatch.setattr(dpa_api, "scan_max_workers", 1)
+    dpa_api.pets_cache.put(("dog", None), [{"id": "SL1", "species": "dog"}], "1")
+
+    with Stubber(dpa_api.client) as stubber, Stubber(dpa_api.s3_client) as s3_stubber:
+        add_version_response(stubber)
+        add_snapshot_missing(s3_stubber, "snapshots/species/cat.json.gz")
+        stubber.add_response(
+            "query",
+            {"Items": [{"id": {"S": "SL2"}, "species": {"S": "cat"}}]},
+            {
+                "TableName": dpa_api.table_name,
+                "IndexName": "SpeciesIndex",
+                "KeyConditionExpression": "species = :species",
+                "ExpressionAttributeValues": {":species": {"S": "cat"}},
+            },
+        )
+
+        pets = dpa_api.get_pets("dog, cat,dog")
+        assert [pet["id"] for pet in pets] == ["SL1", "SL2"]
+
+        # pages over the merged listing, without another query
+        first = dpa_api.get_pets("dog,cat", limit=1)
+        assert [pet["id"] for pet in first["pets"]] == ["SL1"]
+        second = dpa_api.get_pets("dog,cat", limit=1, cursor=first["next_cursor"])
+        assert [pet["id"] for pet in second["pets"]] == ["SL2"]
+        assert second["next_cursor"] is None
+
+        with pytest.raises(HTTPException) as excinfo:
+            dpa_api.get_pets("dog", limit=1, cursor=first["next_cursor"])
+        assert excinfo.value.status_code == 400
+
+        stubber.assert_no_pending_responses()
+        s3_stubber.assert_no_pending_responses()
+
+
+def test_list_pets_multiple_species_filtered():
+    dpa_api.catalog_cache.put((None, None), catalog, "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        pets = dpa_api.get_pets("cat,Dog", age="baby")
+        assert [pet["id"] for pet in pets] == ["SL3", "AT4"]
+
+        stubber.assert_no_pending_responses()
+
+
+def test_single_flight_shares_result():
+    cache = dpa_api.TTLCache(8, 60)
+    barrier = threading.Barrier(8)
+    calls = []
+
+    def load():
+        calls.append(1)
+        # give the other callers time to join the flight
+        time.sleep(0.2)
+        return ["pets"]
+
+    def request():
+        barrier.wait()
+        return cache.get_or_load(("dog", None), "1", load)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: request(), range(8)))
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+    # later callers are served from the cache, a new version loads again
+    assert cache.get_or_load(("dog", None), "1", load) is results[0]
+    cache.get_or_load(("dog", None), "2", load)
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_errors():
+    flights = dpa_api.SingleFlight()
+    barrier = threading.Barrier(4)
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.2)
+        raise HTTPException(status_code=404)
+
+    def request():
+        barrier.wait()
+        with pytest.raises(HTTPException):
+            flights.do("key", load)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda _: request(), range(4)))
+
+    assert len(calls) == 1
+    assert flights._calls == {}
+
+
+def test_request_metrics(capsys):
+    # the same wrapping PETS_METRICS=1 sets up at import
+    app = BaseHTTPMiddleware(dpa_api.app, dispatch=dpa_api.record_metrics)
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+        stubber.add_response(
+            "scan",
+            {
+                "Items": [{"id": {"S": "1"}}, {"id": {"S": "2"}}],
+                "ConsumedCapacity": {"TableName": "Pets", "CapacityUnits": 0.5},
+            },
+            {
+                "TableName": dpa_api.table_name,
+                "Limit": 2,
+                "ReturnConsumedCapacity": "TOTAL",
+            },
+        )
+
+        response = TestClient(app).get(
+            "/pets?limit=2", headers={"Accept-Encoding": "identity"}
+        )
+        assert response.json()["pets"] == [{"id": "1"}, {"id": "2"}]
+
+        timing = response.headers["server-timing"]
+        assert 'desc="1 pages, 2 items, 0.5 RCU"' in timing
+        for phase in ("dynamodb;dur=", "decode;dur=", "serialize;dur=", "total;dur="):
+            assert phase in timing
+
+        stubber.assert_no_pending_responses()
+
+    metrics = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert metrics["Route"] == "/pets"
+    assert metrics["StatusCode"] == 200
+    assert metrics["DynamoDBPages"] == 1
+    assert metrics["DynamoDBItems"] == 2
+    assert metrics["ConsumedReadCapacity"] == 0.5
+    definition = metrics["_aws"]["CloudWatchMetrics"][0]
+    assert definition["Dimensions"] == [["Route"]]
+    assert {"Name": "DecodeTime", "Unit": "Milliseconds"} in definition["Metrics"]
+
+
+def test_request_metrics_disabled(capsys):
+    # Middleware keeps its arguments in kwargs, or options before Starlette 0.35
+    assert not any(
+        getattr(middleware, "kwargs", getattr(middleware, "options", {})).get(
+            "dispatch"
+        )
+        is dpa_api.record_metrics
+        for middleware in dpa_api.app.user_middleware
+    )
+    dpa_api.catalog_cache.put((None, None), [], "1")
+
+    with Stubber(dpa_api.client) as stubber:
+        add_version_response(stubber)
+
+        response = TestClient(dpa_api.app).get(
+            "/pets", headers={"Accept-Encoding": "identity"}
+        )
+
+        assert "server-timing" not in response.headers
+        assert capsys.readouterr().out == ""
@@ -0,0 +1,52 @@
+import importlib.util
+import os
+
+import pytest
+
+import dpa_api
+
+# pet_sync builds the published search index with its own copy of the
+# tokenizer, and queries are tokenized here, so the two have to agree
+pytest.importorskip("requests", reason="pet_sync needs requests to import")
+
+pet_sync_path = os.path.join(
+    os.path.dirname(__file__), "..", "..", "sync", "src", "pet_sync.py"
+)
+spec = importlib.util.spec_from_file_location("pet_sync", pet_sync_path)
+pet_sync = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pet_sync)
+
+texts = [
+    "Biscuit is a playful, house-trained puppy!",
+    "Crème Brûlée loves cuddles and the outdoors",
+    "She's 3 years old, SPAYED and trained with cats",
+    "",
+    "the and of a",
+    "Puppies running, jumped, kisses, grass",
+]
+
+
+def test_search_settings_match():
+    assert dpa_api.search_field_weights == pet_sync.search_field_weights
+    assert dpa_api.search_stopwords == pet_sync.search_stopwords
+
+
+@pytest.mark.parametrize("text", texts)
+def test_tokenize_matches(text):
+    assert dpa_api.tokenize(text) == pet_sync.tokenize(text)
+
+
+def test_build_search_index_matches():
+    pets = [
+        {
+            "id": str(position),
+            "name": text.split(" ")[0],
+            "breed": "Labrador Retriever mix",
+            "color": "Black/White",
+            "description": text,
+        }
+        for position, text in enumerate(texts)
+    ]
+    pets.append({"id": "bare", "name": None, "description": 4})
+
+    assert dpa_api.build_search_index(pets) == pet_sync.build_search_index(pets)
@@ -1,77 +1,228 @@
+import gzip
+import hashlib
 import json
 import logging
+import os
+import random
+import re
 import requests
-from typing import Any, Dict, List, Optional
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import boto3
 import botocore
 from cerealbox.dynamo import from_dynamodb_json
 
+try:
+    import brotli
+except ImportError:  # optional, only the gzip snapshots are published without it
+    brotli = None
+
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 dynamodb_client = boto3.client("dynamodb")
 table_name = "Pets"
+meta_table_name = "PetsMeta"
+
+batch_get_chunk_size = 100
+batch_get_max_attempts = 5
+batch_get_backoff_seconds = 0.05
+
+# the SyncIndex read is split into this many parallel scan segments
+scan_segments = int(os.environ.get("PETS_SCAN_SEGMENTS", "1"))
+scan_max_workers = 8
 
 dynamodb_resource = boto3.resource("dynamodb")
 pets_table = dynamodb_resource.Table(table_name)
 
 secrets_client = boto3.client("secretsmanager")
+# fetched together and kept across warm invocations for secrets_ttl_seconds
+sync_secrets = ("shelterluv_api_key", "airtable_personal_access_token", "airtable_base")
+secrets_ttl_seconds = 60 * 60
+_secrets: Dict[str, Any] = {"values": None, "fetchedAt": 0.0}
+_secrets_lock = threading.Lock()
+
+# one session per source, so warm invocations reuse their connections
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+shelterluv_url = "https://www.shelterluv.com/api/v1/animals"
+shelterluv_page_size = 100
+# pages after the first are fetched this many at a time
+shelterluv_max_workers = 4
+
+airtable_url = "https://api.airtable.com/v0/{}/Pets"
+airtable_available = "Published - Available for Adoption"
+# only what parse_new_digs_pets reads
+airtable_fields = (
+    "Status",
+    "Pet ID - do not edit",
+    "Pet Name",
+    "Pet Species",
+    "Pet Size",
+    "Pet Age",
+    "Sex",
+    "Breed - Dog",
+    "Color - Dog",
+    "Breed - Cat",
+    "Color - Cat",
+    "Breed - Other Species",
+    "Color - Other Species",
+    "Pictures",
+    "PictureMap-DoNotModify",
+    "ThumbnailURL",
+    "Public Description",
+    "Youtube Video",
+)
+# incremental runs only see edits, deleted records drop out on the next
+# full run
+airtable_full_sync_seconds = 24 * 60 * 60
+# re-read edits this close to the last watermark to allow for clock skew
+airtable_watermark_overlap_seconds = 5 * 60
+
+s3_client = boto3.client("s3")
+snapshot_bucket = "dpa-api-catalog"
+
+api_fields_keys = ("id", "name", "species", "sex", "breed", "color", "age")
+# species must stay first, species views count the rest
+facet_attributes = ("species", "size", "age", "sex", "location")
+age_groups = ("Baby", "Young", "Adult", "Senior")
+_string_list_attributes = frozenset(("photos",))
+# kept on the items for the sync's diff, left out of the snapshots
+_internal_attributes = frozenset(("contentHash",))
+
+# must match dpa_api, which tokenizes search queries the same way
+# (api/tests/test_search_parity.py compares the two)
+search_field_weights = {"name": 8, "breed": 4, "color": 2, "description": 1}
+search_stopwords = frozenset(
+    "a an and are as at be but by for from has have he her his i in is it its "
+    "of on or she that the their they this to was were will with".split()
+)
+_search_token = re.compile(r"[a-z0-9]+")
+
+
+# fetch and parse for each source, looked up when called. Each returns the
+# source's pets and a checkpoint to run once they are written, or None
+source_pipelines = {
+    "shelterluv": lambda _: (parse_shelterluv_pets(get_shelterluv_pets()), None),
+    "airtable": lambda dynamodb_pets: get_airtable_pets(dynamodb_pets),
+}
 
 
 def handler(_, __):
     # get the current list of pets
     current_pets = get_pets()
 
-    api_shelterluv_pets = get_shelterluv_pets()
-    api_shelterluv_pets = parse_shelterluv_pets(api_shelterluv_pets)
+    # SyncIndex projects every facet attribute, so the counts start from
+    # what is in the table rather than a document an earlier run may have
+    # left behind
+    facets = FacetCounts.from_pets(
+        current_pets["shelterluv"] + current_pets["airtable"]
+    )
+
+    # the sources share nothing but the read above, so they run side by
+    # side and one failing leaves the other's writes in place
+    with ThreadPoolExecutor(max_workers=len(source_pipelines)) as executor:
+        futures = {
+            source: executor.submit(sync_source, source, current_pets[source], facets)
+            for source in source_pipelines
+        }
+
+    api_pets = {}
+    summary = {"sources": {}}
+    for source, future in futures.items():
+        try:
+            api_pets[source], counts = future.result()
+        except Exception as e:
+            logger.exception("%s sync failed", source)
+            summary["sources"][source] = {"status": "failed", "error": repr(e)}
+        else:
+            summary["sources"][source] = {"status": "ok", **counts}
 
-    dynamodb_shelterluv_pets = current_pets["shelterluv"]
+    if not api_pets:
+        raise RuntimeError("Every source failed to sync")
 
-    update_pets(api_shelterluv_pets, dynamodb_shelterluv_pets)
+    # snapshots and facets go out tagged with the version the bump below
+    # produces, so API containers that see the new marker find them current
+    # rather than falling back to a scan while they are written
+    version = read_sync_version() + 1
+    try:
+        # the counts started from the table and only follow flushed
+        # writes, so they hold after a failed source too
+        save_facets(facets, version)
 
-    api_airtable_pets = get_new_digs_pets()
-    api_airtable_pets = parse_new_digs_pets(api_airtable_pets)
+        if len(api_pets) == len(source_pipelines):
+            all_pets = [pet for pets in api_pets.values() for pet in pets.values()]
+            publish_snapshot(all_pets, version)
+        else:
+            # without every source's pets the snapshots would be incomplete,
+            # the API reads DynamoDB instead until the next full sync
+            logger.warning("Skipping snapshots after a failed source")
+    finally:
+        # the pets are written either way, so the marker has to move on. A
+        # failed source's state is unknown, so give it a hash that can't
+        # match any earlier etag
+        summary["version"] = bump_sync_version(
+            {
+                source: catalog_hash(api_pets[source])
+                if source in api_pets
+                else "failed:{}".format(time.time())
+                for source in source_pipelines
+            }
+        )
 
-    dynamodb_airtable_pets = current_pets["airtable"]
+    if summary["version"] != version:
+        logger.warning(
+            "Catalog version moved to %s during the sync, the snapshots are "
+            "stale until the next run",
+            summary["version"],
+        )
 
-    update_pets(api_airtable_pets, dynamodb_airtable_pets)
+    logger.info("Sync summary: %s", json.dumps(summary))
+    return summary
 
 
-def get_pets() -> Optional[Dict[str, Any]]:
-    pets = []
+def sync_source(
+    source: str, dynamodb_pets: List[Dict[str, Any]], facets: "FacetCounts"
+) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """
+    Fetch, parse and write one source's pets, returning them along with
+    the update_pets counts.
+    """
+    api_pets, checkpoint = source_pipelines[source](dynamodb_pets)
+    add_content_hashes(api_pets)
+    add_first_seen(api_pets, dynamodb_pets)
 
-    try:
-        response = dynamodb_client.scan(
-            TableName=table_name,
-            IndexName="SyncIndex",
-        )
+    counts = update_pets(api_pets, dynamodb_pets, facets)
+    if checkpoint is not None:
+        checkpoint()
 
-        if "Items" not in response:
-            logger.error("No pets found")
-            return None
+    return api_pets, counts
 
-        pets = response["Items"]
 
-        while lastKey := response.get("LastEvaluatedKey"):
-            response = dynamodb_client.scan(
-                TableName=table_name,
-                IndexName="SyncIndex",
-                ExclusiveStartKey=lastKey,
-            )
-            pets.extend(response["Items"])
+def get_pets() -> Optional[Dict[str, Any]]:
+    try:
+        pets = scan_table(scan_segments, TableName=table_name, IndexName="SyncIndex")
     except botocore.exceptions.ClientError:
         logger.exception("client error")
         raise
 
+    if pets is None:
+        logger.error("No pets found")
+        return None
+
     formatted_pets = {
         "shelterluv": [],
         "airtable": [],
     }
 
     for pet in pets:
-        formatted_pet = from_dynamodb_json(pet)
+        formatted_pet = decode_pet(pet)
         if formatted_pet.get("source") == "shelterluv":
             formatted_pets["shelterluv"].append(formatted_pet)
         elif formatted_pet.get("source") == "airtable":
@@ -83,55 +234,158 @@ def get_pets() -> Optional[Dict[str, Any]]:
     return formatted_pets
 
 
-def get_shelterluv_pets() -> Dict[str, Any]:
-    response = secrets_client.get_secret_value(SecretId="shelterluv_api_key")
-    shelterluv_api_key = response["SecretString"]
+def decode_pet(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Decode a Pets item from DynamoDB JSON. The shapes pet_sync writes
+    (strings, NULL for a missing video or size, and the photos string list)
+    are unpacked inline; any other attribute goes through cerealbox.
+    """
+    pet = {}
+    for key, value in item.items():
+        if "S" in value:
+            pet[key] = value["S"]
+        elif "NULL" in value:
+            pet[key] = None
+        elif "L" in value and key in _string_list_attributes:
+            try:
+                pet[key] = [entry["S"] for entry in value["L"]]
+            except KeyError:
+                pet[key] = from_dynamodb_json({key: value})[key]
+        else:
+            pet[key] = from_dynamodb_json({key: value})[key]
+    return pet
 
-    headers = {"x-api-key": shelterluv_api_key}
-    offset = 0
-    animals_dict = {}
 
-    while 1:
-        url = (
-            "https://www.shelterluv.com/api/v1/"
-            + "animals?status_type=publishable&offset="
-            + str(offset)
-        )
-        response = requests.get(url, headers=headers)
+def scan_table(
+    total_segments: int = 1, **kwargs: Any
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Scan every page of a table or index, fanning out over total_segments
+    parallel scan segments when more than one is requested. Segments are
+    concatenated in segment order so the result order is stable.
+    """
+    if total_segments <= 1:
+        return scan_segment(kwargs)
+
+    def run(segment: int) -> Optional[List[Dict[str, Any]]]:
+        return scan_segment(dict(kwargs, Segment=segment, TotalSegments=total_segments))
+
+    workers = min(total_segments, scan_max_workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        segments = list(executor.map(run, range(total_segments)))
+
+    if any(items is None for items in segments):
+        return None
+
+    return [item for items in segments for item in items]
+
+
+def scan_segment(kwargs: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    response = dynamodb_client.scan(**kwargs)
+
+    if "Items" not in response:
+        return None
+
+    items = response["Items"]
+
+    while lastKey := response.get("LastEvaluatedKey"):
+        response = dynamodb_client.scan(**kwargs, ExclusiveStartKey=lastKey)
+        items.extend(response["Items"])
+
+    return items
+
+
+class SecretRejected(Exception):
+    """
+    A source answered 401 or 403, the cached secret may have been rotated.
+    """
+
+
+def get_secrets(refresh: bool = False) -> Dict[str, str]:
+    """
+    Every secret the sync uses, from one BatchGetSecretValue call. They are
+    kept across warm invocations until secrets_ttl_seconds have passed or
+    a refresh is asked for.
+    """
+    with _secrets_lock:
+        age = time.time() - _secrets["fetchedAt"]
+        if refresh or _secrets["values"] is None or age >= secrets_ttl_seconds:
+            try:
+                response = secrets_client.batch_get_secret_value(
+                    SecretIdList=list(sync_secrets)
+                )
+            except botocore.exceptions.ClientError:
+                logger.exception("client error")
+                raise
+
+            if response.get("Errors"):
+                logger.error("Secrets Manager errors: %s", response["Errors"])
+                raise ValueError("Couldn't fetch the sync secrets")
+
+            _secrets["values"] = {
+                secret["Name"]: secret["SecretString"]
+                for secret in response["SecretValues"]
+            }
+            _secrets["fetchedAt"] = time.time()
 
-        # check http response code
-        if response.status_code != 200:
-            logger.error(
-                "Invalid response code from Shelterluv {}".format(response.status_code)
+        return _secrets["values"]
+
+
+def with_fresh_secrets(fetch: Callable[[Dict[str, str]], Any]) -> Any:
+    """
+    Call fetch with the cached secrets, and once more with newly fetched
+    ones if the source rejects them.
+    """
+    try:
+        return fetch(get_secrets())
+    except SecretRejected:
+        logger.warning("Credentials were rejected, fetching the secrets again")
+        return fetch(get_secrets(refresh=True))
+
+
+def http_session(name: str, pool_maxsize: int = 1) -> requests.Session:
+    """
+    The session for one source, created on first use and kept across warm
+    invocations, with a pool of pool_maxsize connections to its host.
+    """
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_maxsize
             )
-            raise ValueError("Invalid response code from Shelterluv")
+            session.mount("https://", adapter)
+            _sessions[name] = session
+        return session
 
-        response_json = response.json()
 
-        if response_json["success"] != 1:
-            logger.error("Invalid response from Shelterluv {}".format(response_json))
-            raise ValueError("Invalid response from Shelterluv")
+def clear_caches() -> None:
+    with _secrets_lock:
+        _secrets.update(values=None, fetchedAt=0.0)
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
 
-        total_count = response_json["total_count"]
 
-        if total_count == "0":
-            logger.error("No animals found from Shelterluv")
-            raise ValueError("No animals found from Shelterluv")
+def get_shelterluv_pets() -> Dict[str, Any]:
+    pages = with_fresh_secrets(
+        lambda secrets: get_shelterluv_pages(secrets["shelterluv_api_key"])
+    )
+    total_count = pages[0]["total_count"]
+
+    animals_dict = {}
 
-        # add each animal to the dict
-        for animal in response_json["animals"]:
+    # add each animal to the dict, in page order
+    for page in pages:
+        for animal in page["animals"]:
             id = animal["ID"]
             if id in animals_dict:
                 continue
 
             animals_dict[id] = animal
 
-        # check for more animals
-        if response_json["has_more"]:
-            offset += 100
-        else:
-            break
-
     # we should have all the animals now
     if str(animals_dict.__len__()) != str(total_count):
         logger.error("something went wrong, missing animals from shelterluv")
@@ -139,6 +393,64 @@ def get_shelterluv_pets() -> Dict[str, Any]:
     return animals_dict
 
 
+def get_shelterluv_pages(api_key: str) -> List[Dict[str, Any]]:
+    # keep a connection open per worker
+    session = http_session("shelterluv", shelterluv_max_workers)
+    headers = {"x-api-key": api_key}
+
+    first_page = get_shelterluv_page(session, headers, 0)
+    total_count = first_page["total_count"]
+
+    if total_count == "0":
+        logger.error("No animals found from Shelterluv")
+        raise ValueError("No animals found from Shelterluv")
+
+    pages = [first_page]
+    if first_page["has_more"]:
+        # total_count gives every remaining offset up front
+        offsets = range(shelterluv_page_size, int(total_count), shelterluv_page_size)
+        with ThreadPoolExecutor(max_workers=shelterluv_max_workers) as executor:
+            pages.extend(
+                executor.map(
+                    lambda offset: get_shelterluv_page(session, headers, offset),
+                    offsets,
+                )
+            )
+
+    # animals added since the first page push the end further out
+    offset = shelterluv_page_size * (len(pages) - 1)
+    while pages[-1]["has_more"]:
+        offset += shelterluv_page_size
+        pages.append(get_shelterluv_page(session, headers, offset))
+
+    return pages
+
+
+def get_shelterluv_page(
+    session: requests.Session, headers: Dict[str, str], offset: int
+) -> Dict[str, Any]:
+    url = shelterluv_url + "?status_type=publishable&offset=" + str(offset)
+    response = session.get(url, headers=headers)
+
+    if response.status_code in (401, 403):
+        raise SecretRejected("Shelterluv rejected the API key")
+
+    # check http response code
+    if response.status_code != 200:
+        logger.error(
+            "Invalid response code from Shelterluv {}".format(response.status_code)
+        )
+        raise ValueError("Invalid response code from Shelterluv")
+
+    response_json = response.json()
+
+    if response_json["success"] != 1:
+        logger.error("Invalid response from Shelterluv {}".format(response_json))
+        raise ValueError("Invalid response from Shelterluv")
+
+    return response_json
+
+
 def parse_shelterluv_pets(animals_dict: Dict[str, Any]) -> Dict[str, Any]:
     animals = {}
     for id, animal in animals_dict.items():
@@ -210,34 +522,86 @@ def parse_shelterluv_pets(animals_dict: Dict[str, Any]) -> Dict[str, Any]:
     return animals
 
 
-def get_new_digs_pets() -> List[Dict[str, Any]]:
-    response = secrets_client.get_secret_value(
-        SecretId="airtable_personal_access_token"
+def get_airtable_pets(
+    dynamodb_pets: List[Dict[str, Any]]
+) -> Tuple[Dict[str, Any], Callable[[], None]]:
+    """
+    Fetch the available New Digs pets. Between full runs only the records
+    modified since the stored watermark are downloaded, and the pets they
+    leave untouched are read back from the Pets table. The returned
+    checkpoint moves the watermark on.
+    """
+    state = load_airtable_state()
+    started = time.time()
+
+    if state is None or started - state["fullSyncAt"] >= airtable_full_sync_seconds:
+        logger.info("Fetching every available Airtable pet")
+        records = get_new_digs_pets("{Status} = '%s'" % airtable_available)
+        pets = parse_new_digs_pets(records)
+        full_sync_at = started
+    else:
+        since = time.strftime(
+            "%Y-%m-%dT%H:%M:%S.000Z",
+            time.gmtime(state["watermark"] - airtable_watermark_overlap_seconds),
+        )
+        logger.info("Fetching Airtable pets modified since %s", since)
+        # no status filter, a pet that was adopted has to be seen to go
+        records = get_new_digs_pets(
+            "IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('%s'))" % since
+        )
+        modified = {
+            "AT" + str(record["fields"]["Pet ID - do not edit"])
+            for record in records
+            if "Pet ID - do not edit" in record.get("fields", {})
+        }
+        pets = get_stored_pets(
+            [pet["id"] for pet in dynamodb_pets if pet["id"] not in modified]
+        )
+        pets.update(parse_new_digs_pets(records))
+        full_sync_at = state["fullSyncAt"]
+
+    def checkpoint() -> None:
+        save_airtable_state(started, full_sync_at)
+
+    return pets, checkpoint
+
+
+def get_new_digs_pets(formula: Optional[str] = None) -> List[Dict[str, Any]]:
+    return with_fresh_secrets(
+        lambda secrets: get_new_digs_records(
+            secrets["airtable_personal_access_token"],
+            secrets["airtable_base"],
+            formula,
+        )
     )
-    airtable_api_key = response["SecretString"]
 
-    response = secrets_client.get_secret_value(SecretId="airtable_base")
-    airtable_base = response["SecretString"]
 
-    url = "https://api.airtable.com/v0/" + airtable_base + "/Pets"
-    headers = {"Authorization": "Bearer " + airtable_api_key}
+def get_new_digs_records(
+    api_key: str, base: str, formula: Optional[str]
+) -> List[Dict[str, Any]]:
+    session = http_session("airtable")
+    url = airtable_url.format(base)
+    headers = {"Authorization": "Bearer " + api_key}
 
     offset = None
     quit = False
     pets_list = []
 
     while not quit:
-        params = {}
+        params: Dict[str, Any] = {"fields[]": list(airtable_fields)}
+        if formula:
+            params["filterByFormula"] = formula
         if offset:
-            params = {"offset": offset}
+            params["offset"] = offset
 
-        response = requests.get(url, headers=headers, params=params)
+        response = session.get(url, headers=headers, params=params)
+        if response.status_code in (401, 403):
+            raise SecretRejected("Airtable rejected the access token")
         if response.status_code != requests.codes.ok:
             logger.error("Airtable response: ")
             logger.error(response)
             logger.error("URL: " + url)
-            logger.error("Headers: " + str(headers))
-            return
+            raise ValueError("Invalid response code from Airtable")
 
         airtable_response = response.json()
 
@@ -251,12 +615,89 @@ def get_new_digs_pets() -> List[Dict[str, Any]]:
     return pets_list
 
 
+def get_stored_pets(ids: List[str]) -> Dict[str, Any]:
+    """
+    Read whole pets back from the Pets table, batch_get_chunk_size keys per
+    BatchGetItem.
+    """
+    pets = {}
+    for start in range(0, len(ids), batch_get_chunk_size):
+        pets.update(batch_get_pets(ids[start : start + batch_get_chunk_size]))
+    return pets
+
+
+def batch_get_pets(ids: List[str]) -> Dict[str, Any]:
+    """
+    BatchGetItem one chunk of pets, retrying UnprocessedKeys with capped,
+    jittered exponential backoff.
+    """
+    request = {table_name: {"Keys": [{"id": {"S": id}} for id in ids]}}
+
+    pets = {}
+    for attempt in range(batch_get_max_attempts):
+        if attempt:
+            delay = batch_get_backoff_seconds * 2 ** (attempt - 1)
+            time.sleep(delay + random.uniform(0, delay))
+
+        try:
+            response = dynamodb_client.batch_get_item(RequestItems=request)
+        except botocore.exceptions.ClientError:
+            logger.exception("client error")
+            raise
+
+        for item in response.get("Responses", {}).get(table_name, []):
+            pet = decode_pet(item)
+            pets[pet["id"]] = pet
+
+        request = response.get("UnprocessedKeys")
+        if not request:
+            return pets
+
+    logger.error("unprocessed keys after %s attempts", batch_get_max_attempts)
+    raise RuntimeError("Pets table kept throttling BatchGetItem")
+
+
+def load_airtable_state() -> Optional[Dict[str, float]]:
+    try:
+        response = dynamodb_client.get_item(
+            TableName=meta_table_name,
+            Key={"id": {"S": "airtable-sync"}},
+        )
+    except botocore.exceptions.ClientError:
+        logger.exception("client error")
+        raise
+
+    item = response.get("Item")
+    if not item:
+        return None
+
+    return {
+        "watermark": float(item["watermark"]["N"]),
+        "fullSyncAt": float(item["fullSyncAt"]["N"]),
+    }
+
+
+def save_airtable_state(watermark: float, full_sync_at: float) -> None:
+    try:
+        dynamodb_client.put_item(
+            TableName=meta_table_name,
+            Item={
+                "id": {"S": "airtable-sync"},
+                "watermark": {"N": str(watermark)},
+                "fullSyncAt": {"N": str(full_sync_at)},
+            },
+        )
+    except botocore.exceptions.ClientError:
+        logger.exception("client error")
+        raise
+
+
 def parse_new_digs_pets(animals_list: List[Dict[str, Any]]) -> Dict[str, Any]:
     animals = {}
     for animal in animals_list:
         try:
             fields = animal["fields"]
-            if fields["Status"] != "Published - Available for Adoption":
+            if fields["Status"] != airtable_available:
                 continue
 
             at_id = "AT" + str(fields["Pet ID - do not edit"])
@@ -339,26 +780,362 @@ def parse_new_digs_pets(animals_list: List[Dict[str, Any]]) -> Dict[str, Any]:
     return animals
 
 
-def update_pets(api_pets: Dict[str, Any], dynamodb_pets: Dict[str, Any]) -> None:
-    deleted_pets = 0
-    updated_pets = 0
-
-    ids_to_delete = [pet["id"] for pet in dynamodb_pets]
-
-    for ddb_pet in dynamodb_pets:
-        if ddb_pet["id"] in api_pets:
-            ids_to_delete.remove(ddb_pet["id"])
+def update_pets(
+    api_pets: Dict[str, Any],
+    dynamodb_pets: Dict[str, Any],
+    facets: Optional["FacetCounts"] = None,
+) -> Dict[str, int]:
+    """
+    Write only the difference between the source and DynamoDB: delete pets
+    that are gone, put new pets and pets whose contentHash changed. Returns
+    how many pets were added, changed, removed and left unchanged.
+    """
+    # SyncIndex projects contentHash and the facet attributes, so the old
+    # values are at hand without reading the items
+    existing_pets = {pet["id"]: pet for pet in dynamodb_pets}
+
+    removed = existing_pets.keys() - api_pets.keys()
+    added = [id for id in api_pets if id not in existing_pets]
+    changed = [
+        id
+        for id, pet in api_pets.items()
+        if id in existing_pets
+        and existing_pets[id].get("contentHash") != pet["contentHash"]
+    ]
 
     with pets_table.batch_writer() as batch:
-        for id in ids_to_delete:
+        for id in sorted(removed):
             batch.delete_item(Key={"id": id})
-            deleted_pets += 1
 
-        for pet in api_pets.values():
-            batch.put_item(Item=pet)
-            updated_pets += 1
+        for id in added + changed:
+            batch.put_item(Item=api_pets[id])
+
+    # only once every queued write has been flushed, so a failed batch
+    # leaves the counts matching the table
+    if facets is not None:
+        for id in sorted(removed):
+            facets.remove(existing_pets[id])
+        for id in added + changed:
+            facets.update(existing_pets.get(id), api_pets[id])
+
+    counts = {
+        "added": len(added),
+        "changed": len(changed),
+        "removed": len(removed),
+        "unchanged": len(api_pets) - len(added) - len(changed),
+    }
+    logger.info(
+        "Added %(added)s, changed %(changed)s, removed %(removed)s pets, "
+        "%(unchanged)s unchanged",
+        counts,
+    )
+    return counts
+
+
+class FacetCounts:
+    """
+    Per-value counts of the facet attributes over the whole catalog and
+    within each species, adjusted pet by pet as the sync writes changes.
+    """
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        self.data = data or {"all": {}, "species": {}}
+        # both sources adjust the same counts concurrently
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_pets(cls, pets: List[Dict[str, Any]]) -> "FacetCounts":
+        facets = cls()
+        for pet in pets:
+            facets.add(pet)
+        return facets
+
+    def add(self, pet: Dict[str, Any]) -> None:
+        self._apply(pet, 1)
+
+    def remove(self, pet: Dict[str, Any]) -> None:
+        self._apply(pet, -1)
+
+    def update(self, old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> None:
+        if old is None:
+            self.add(new)
+        elif any(old.get(a) != new.get(a) for a in facet_attributes):
+            self.remove(old)
+            self.add(new)
+
+    def total(self) -> int:
+        return sum(self.data["all"].get("species", {}).values())
+
+    def _apply(self, pet: Dict[str, Any], delta: int) -> None:
+        with self._lock:
+            self._apply_locked(pet, delta)
+
+    def _apply_locked(self, pet: Dict[str, Any], delta: int) -> None:
+        views = [(self.data["all"], facet_attributes)]
+        species = pet.get("species")
+        if species:
+            species_view = self.data["species"].setdefault(species, {})
+            views.append((species_view, facet_attributes[1:]))
+
+        for view, attributes in views:
+            for attribute in attributes:
+                value = pet.get(attribute)
+                if value is None:
+                    continue
+                counts = view.setdefault(attribute, {})
+                counts[value] = counts.get(value, 0) + delta
+                if counts[value] <= 0:
+                    del counts[value]
+                if not counts:
+                    del view[attribute]
+
+        if species and not self.data["species"][species]:
+            del self.data["species"][species]
+
+
+def save_facets(facets: FacetCounts, version: int) -> None:
+    try:
+        dynamodb_client.put_item(
+            TableName=meta_table_name,
+            Item={
+                "id": {"S": "facets"},
+                "facets": {"S": json.dumps(facets.data, separators=(",", ":"))},
+                "version": {"N": str(version)},
+            },
+        )
+    except botocore.exceptions.ClientError:
+        logger.exception("client error")
+        raise
+
+
+def content_hash(data: Any) -> str:
+    encoded = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:32]
+
+
+def add_content_hashes(pets: Dict[str, Any]) -> None:
+    """
+    Store a fingerprint of each pet's attributes on the pet as contentHash.
+    """
+    for pet in pets.values():
+        pet.pop("contentHash", None)
+        # pets read back from the table already carry their firstSeen
+        pet["contentHash"] = content_hash(
+            {key: value for key, value in pet.items() if key != "firstSeen"}
+        )
+
+
+def add_first_seen(api_pets: Dict[str, Any], dynamodb_pets: List[Any]) -> None:
+    """
+    Carry each pet's firstSeen over from DynamoDB so it stays put across
+    syncs, stamping pets that are new with the current time.
+    """
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    first_seen = {pet["id"]: pet.get("firstSeen") for pet in dynamodb_pets}
+
+    for pet in api_pets.values():
+        pet["firstSeen"] = first_seen.get(pet["id"]) or now
+
+
+def build_orderings(pets: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """
+    Pet ids newest first, by name and by age group, for the API's sort=.
+    """
+    ages = {age: rank for rank, age in enumerate(age_groups)}
+
+    def by_name(pet):
+        return ((pet.get("name") or "").casefold(), pet["id"])
+
+    newest = sorted(pets, key=lambda pet: (pet.get("firstSeen") or "", pet["id"]))
+    return {
+        "newest": [pet["id"] for pet in reversed(newest)],
+        "name": [pet["id"] for pet in sorted(pets, key=by_name)],
+        "age": [
+            pet["id"]
+            for pet in sorted(
+                pets,
+                key=lambda pet: (ages.get(pet.get("age"), len(ages)), by_name(pet)),
+            )
+        ],
+    }
+
+
+def catalog_hash(pets: Dict[str, Any]) -> str:
+    return content_hash(sorted((id, pet["contentHash"]) for id, pet in pets.items()))
+
+
+def read_sync_version() -> int:
+    try:
+        response = dynamodb_client.get_item(
+            TableName=meta_table_name,
+            Key={"id": {"S": "catalog"}},
+            ProjectionExpression="version",
+        )
+    except botocore.exceptions.ClientError:
+        logger.exception("client error")
+        raise
+
+    return int(response.get("Item", {}).get("version", {}).get("N", "0"))
+
+
+def bump_sync_version(hashes: Optional[Dict[str, str]] = None) -> int:
+    """
+    Increment the catalog version marker so API containers drop their
+    cached responses, recording the per-source catalog hashes and the
+    combined etag the API sends for conditional requests.
+    """
+    update_expression = "ADD version :one SET updatedAt = :now"
+    values = {
+        ":one": {"N": "1"},
+        ":now": {"N": str(int(time.time()))},
+    }
+
+    if hashes:
+        update_expression += ", catalogHashes = :hashes, etag = :etag"
+        values[":hashes"] = {"M": {k: {"S": v} for k, v in hashes.items()}}
+        values[":etag"] = {"S": content_hash(hashes)}
+
+    try:
+        response = dynamodb_client.update_item(
+            TableName=meta_table_name,
+            Key={"id": {"S": "catalog"}},
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_NEW",
+        )
+    except botocore.exceptions.ClientError:
+        logger.exception("client error")
+        raise
+
+    version = int(response["Attributes"]["version"]["N"])
+    logger.info("Catalog version is now %s", version)
+
+    return version
+
+
+def publish_snapshot(pets: List[Dict[str, Any]], version: int) -> None:
+    """
+    Write the full listing, each species slice and their api_fields views to
+    S3 as gzipped JSON so the API can serve them with a single read, along
+    with the search index and sort orderings over the full listing.
+    """
+    pets = sorted(
+        (
+            {
+                key: value
+                for key, value in pet.items()
+                if key not in _internal_attributes
+            }
+            for pet in pets
+        ),
+        key=lambda pet: pet["id"],
+    )
+
+    views = {"snapshots/pets": pets}
+    for pet in pets:
+        key = "snapshots/species/" + pet["species"]
+        views.setdefault(key, []).append(pet)
+
+    metadata = {
+        "sync-version": str(version),
+        "generated-at": str(int(time.time())),
+    }
+
+    try:
+        for key, view in views.items():
+            trimmed = [
+                {field: pet.get(field) for field in api_fields_keys} for pet in view
+            ]
+            # the API serves these bytes as they are for Accept-Encoding
+            put_snapshot(key + ".json.gz", view, metadata, brotli_variant=True)
+            put_snapshot(
+                key + "-api-fields.json.gz", trimmed, metadata, brotli_variant=True
+            )
+
+        put_snapshot(
+            "snapshots/search-index.json.gz", build_search_index(pets), metadata
+        )
+        put_snapshot("snapshots/orderings.json.gz", build_orderings(pets), metadata)
+    except botocore.exceptions.ClientError:
+        logger.exception("client error")
+        raise
+
+    logger.info("Published %s snapshot views for version %s", len(views) * 2, version)
+
+
+def put_snapshot(
+    key: str, data: Any, metadata: Dict[str, str], brotli_variant: bool = False
+) -> None:
+    """
+    Write data as gzipped JSON to key and, when asked and brotli is
+    installed, a brotli copy alongside it with a .br extension instead.
+    """
+    body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    # a fixed mtime keeps the bytes identical for identical catalogs
+    s3_client.put_object(
+        Bucket=snapshot_bucket,
+        Key=key,
+        Body=gzip.compress(body, mtime=0),
+        ContentType="application/json",
+        ContentEncoding="gzip",
+        Metadata=metadata,
+    )
+
+    if brotli_variant and brotli is not None:
+        s3_client.put_object(
+            Bucket=snapshot_bucket,
+            Key=key[: -len(".gz")] + ".br",
+            Body=brotli.compress(body),
+            ContentType="application/json",
+            ContentEncoding="br",
+            Metadata=metadata,
+        )
 
-    logger.info("Deleted %s pets", deleted_pets)
-    logger.info("Updated/added %s pets", updated_pets)
 
-    assert updated_pets == len(api_pets)
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore")
+    return text.decode("ascii").lower()
+
+
+def stem(token: str) -> str:
+    # deliberately light: just enough that "puppies" finds "puppy" and
+    # "trained" finds "train"
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 5 and token.endswith("ing"):
+        return token[:-3]
+    if len(token) > 4 and token.endswith("ed"):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        stem(token)
+        for token in _search_token.findall(normalize_text(text))
+        if token not in search_stopwords
+    ]
+
+
+def build_search_index(pets: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Build the token index the API searches: the pet ids in listing order
+    and, per token, [position, score] pairs weighted by matching field.
+    """
+    ids = []
+    postings: Dict[str, List[List[int]]] = {}
+
+    for position, pet in enumerate(pets):
+        ids.append(pet["id"])
+        scores: Dict[str, int] = {}
+        for field, weight in search_field_weights.items():
+            value = pet.get(field)
+            if isinstance(value, str):
+                for token in set(tokenize(value)):
+                    scores[token] = scores.get(token, 0) + weight
+        for token, score in scores.items():
+            postings.setdefault(token, []).append([position, score])
+
+    return {"ids": ids, "postings": postings}
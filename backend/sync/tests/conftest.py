@@ -0,0 +1,10 @@
+import pytest
+
+from ..src import pet_sync
+
+
+@pytest.fixture(autouse=True)
+def reset_caches():
+    pet_sync.clear_caches()
+    yield
+    pet_sync.clear_caches()
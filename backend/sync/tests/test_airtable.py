@@ -0,0 +1,178 @@
+import json
+import os
+import time
+
+import requests_mock
+import pytest
+from botocore.stub import ANY, Stubber
+
+from ..src import pet_sync
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+airtable_url = "https://api.airtable.com/v0/base/Pets"
+
+
+def sample_records():
+    with open(os.path.join(__location__, "resources/sample_airtable.json"), "r") as f:
+        records = json.load(f)["records"]
+    for record in records:
+        record["fields"].setdefault("PictureMap-DoNotModify", "{}")
+    return records
+
+
+def stub_secrets(stub):
+    stub.add_response(
+        "batch_get_secret_value",
+        {
+            "SecretValues": [
+                {"Name": "shelterluv_api_key", "SecretString": "key"},
+                {"Name": "airtable_personal_access_token", "SecretString": "abc"},
+                {"Name": "airtable_base", "SecretString": "base"},
+            ],
+            "Errors": [],
+        },
+        {"SecretIdList": list(pet_sync.sync_secrets)},
+    )
+
+
+def test_get_airtable_pets_full():
+    with Stubber(pet_sync.dynamodb_client) as dynamodb_stub, Stubber(
+        pet_sync.secrets_client
+    ) as secrets_stub:
+        dynamodb_stub.add_response(
+            "get_item",
+            {},
+            {"TableName": "PetsMeta", "Key": {"id": {"S": "airtable-sync"}}},
+        )
+        stub_secrets(secrets_stub)
+
+        with requests_mock.Mocker(case_sensitive=True) as requests_mocker:
+            requests_mocker.get(airtable_url, json={"records": sample_records()})
+            pets, checkpoint = pet_sync.get_airtable_pets([])
+
+            query = requests_mocker.request_history[0].qs
+            assert query["filterByFormula"] == [
+                "{Status} = 'Published - Available for Adoption'"
+            ]
+            assert query["fields[]"] == list(pet_sync.airtable_fields)
+
+        assert list(pets) == ["AT111"]
+
+        dynamodb_stub.add_response(
+            "put_item",
+            {},
+            {
+                "TableName": "PetsMeta",
+                "Item": {
+                    "id": {"S": "airtable-sync"},
+                    "watermark": {"N": ANY},
+                    "fullSyncAt": {"N": ANY},
+                },
+            },
+        )
+        checkpoint()
+
+        dynamodb_stub.assert_no_pending_responses()
+
+
+def test_get_airtable_pets_incremental():
+    now = time.time()
+    dynamodb_pets = [
+        {"id": "AT60", "source": "airtable"},
+        {"id": "AT7", "source": "airtable"},
+    ]
+
+    with Stubber(pet_sync.dynamodb_client) as dynamodb_stub, Stubber(
+        pet_sync.secrets_client
+    ) as secrets_stub:
+        dynamodb_stub.add_response(
+            "get_item",
+            {
+                "Item": {
+                    "id": {"S": "airtable-sync"},
+                    "watermark": {"N": str(now - 3600)},
+                    "fullSyncAt": {"N": str(now - 7200)},
+                }
+            },
+            {"TableName": "PetsMeta", "Key": {"id": {"S": "airtable-sync"}}},
+        )
+        stub_secrets(secrets_stub)
+        # only the pet Airtable didn't report is read back
+        dynamodb_stub.add_response(
+            "batch_get_item",
+            {
+                "Responses": {
+                    "Pets": [
+                        {
+                            "id": {"S": "AT7"},
+                            "name": {"S": "Rex"},
+                            "video": {"NULL": True},
+                            "firstSeen": {"S": "2024-01-01T00:00:00Z"},
+                            "contentHash": {"S": "old"},
+                        }
+                    ]
+                },
+                "UnprocessedKeys": {},
+            },
+            {"RequestItems": {"Pets": {"Keys": [{"id": {"S": "AT7"}}]}}},
+        )
+
+        with requests_mock.Mocker(case_sensitive=True) as requests_mocker:
+            requests_mocker.get(airtable_url, json={"records": sample_records()})
+            pets, _ = pet_sync.get_airtable_pets(dynamodb_pets)
+
+            (formula,) = requests_mocker.request_history[0].qs["filterByFormula"]
+            assert formula.startswith("IS_AFTER(LAST_MODIFIED_TIME(), ")
+
+        dynamodb_stub.assert_no_pending_responses()
+
+    # AT60 was adopted since the last run and drops out
+    assert sorted(pets) == ["AT111", "AT7"]
+    assert pets["AT7"]["name"] == "Rex"
+
+    # the stored pet hashes the same as it did before firstSeen was added
+    pet_sync.add_content_hashes(pets)
+    assert pets["AT7"]["contentHash"] == pet_sync.content_hash(
+        {"id": "AT7", "name": "Rex", "video": None}
+    )
+
+
+def test_get_stored_pets_retries_unprocessed_keys(monkeypatch):
+    monkeypatch.setattr(pet_sync, "batch_get_backoff_seconds", 0)
+    keys = {"Pets": {"Keys": [{"id": {"S": "AT7"}}]}}
+
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        stub.add_response(
+            "batch_get_item",
+            {"Responses": {"Pets": []}, "UnprocessedKeys": keys},
+            {"RequestItems": keys},
+        )
+        stub.add_response(
+            "batch_get_item",
+            {"Responses": {"Pets": [{"id": {"S": "AT7"}}]}, "UnprocessedKeys": {}},
+            {"RequestItems": keys},
+        )
+
+        assert pet_sync.get_stored_pets(["AT7"]) == {"AT7": {"id": "AT7"}}
+
+        stub.assert_no_pending_responses()
+
+
+def test_get_stored_pets_gives_up(monkeypatch):
+    monkeypatch.setattr(pet_sync, "batch_get_backoff_seconds", 0)
+    monkeypatch.setattr(pet_sync, "batch_get_max_attempts", 2)
+    keys = {"Pets": {"Keys": [{"id": {"S": "AT7"}}]}}
+
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        for _ in range(2):
+            stub.add_response(
+                "batch_get_item",
+                {"Responses": {"Pets": []}, "UnprocessedKeys": keys},
+                {"RequestItems": keys},
+            )
+
+        with pytest.raises(RuntimeError):
+            pet_sync.get_stored_pets(["AT7"])
+
+        stub.assert_no_pending_responses()
@@ -0,0 +1,360 @@
+import gzip
+import json
+from types import SimpleNamespace
+
+import pytest
+from botocore import exceptions
+from botocore.stub import ANY, Stubber
+
+from ..src import pet_sync
+
+
+def test_bump_sync_version():
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        expected_params = {
+            "TableName": "PetsMeta",
+            "Key": {"id": {"S": "catalog"}},
+            "UpdateExpression": "ADD version :one SET updatedAt = :now",
+            "ExpressionAttributeValues": {
+                ":one": {"N": "1"},
+                ":now": ANY,
+            },
+            "ReturnValues": "UPDATED_NEW",
+        }
+        stub.add_response(
+            "update_item",
+            {"Attributes": {"version": {"N": "7"}}},
+            expected_params,
+        )
+
+        assert pet_sync.bump_sync_version() == 7
+
+        stub.assert_no_pending_responses()
+
+
+def test_read_sync_version():
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        expected_params = {
+            "TableName": "PetsMeta",
+            "Key": {"id": {"S": "catalog"}},
+            "ProjectionExpression": "version",
+        }
+        stub.add_response(
+            "get_item", {"Item": {"version": {"N": "7"}}}, expected_params
+        )
+        stub.add_response("get_item", {}, expected_params)
+
+        assert pet_sync.read_sync_version() == 7
+        # before the first sync
+        assert pet_sync.read_sync_version() == 0
+
+        stub.assert_no_pending_responses()
+
+
+def test_bump_sync_version_error():
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        stub.add_client_error("update_item")
+
+        with pytest.raises(exceptions.ClientError):
+            pet_sync.bump_sync_version()
+
+        stub.assert_no_pending_responses()
+
+
+def snapshot_body(data):
+    return gzip.compress(json.dumps(data, separators=(",", ":")).encode(), mtime=0)
+
+
+def test_publish_snapshot(monkeypatch):
+    monkeypatch.setattr(pet_sync, "brotli", None)
+    socks = {"id": "SL2", "name": "Socks", "species": "cat", "description": "x"}
+    fido = {"id": "AT1", "name": "Fido", "species": "dog", "description": "y"}
+    trimmed = {"sex": None, "breed": None, "color": None, "age": None}
+    socks_trimmed = {"id": "SL2", "name": "Socks", "species": "cat", **trimmed}
+    fido_trimmed = {"id": "AT1", "name": "Fido", "species": "dog", **trimmed}
+
+    with Stubber(pet_sync.s3_client) as stub:
+        views = [
+            ("snapshots/pets.json.gz", [fido, socks]),
+            ("snapshots/pets-api-fields.json.gz", [fido_trimmed, socks_trimmed]),
+            ("snapshots/species/dog.json.gz", [fido]),
+            ("snapshots/species/dog-api-fields.json.gz", [fido_trimmed]),
+            ("snapshots/species/cat.json.gz", [socks]),
+            ("snapshots/species/cat-api-fields.json.gz", [socks_trimmed]),
+        ]
+        for key, view in views:
+            expected_params = {
+                "Bucket": "dpa-api-catalog",
+                "Key": key,
+                "Body": snapshot_body(view),
+                "ContentType": "application/json",
+                "ContentEncoding": "gzip",
+                "Metadata": {"sync-version": "3", "generated-at": ANY},
+            }
+            stub.add_response("put_object", {}, expected_params)
+
+        search_index = pet_sync.build_search_index([fido, socks])
+        expected_params = dict(
+            expected_params,
+            Key="snapshots/search-index.json.gz",
+            Body=snapshot_body(search_index),
+        )
+        stub.add_response("put_object", {}, expected_params)
+
+        orderings = {
+            "newest": ["SL2", "AT1"],
+            "name": ["AT1", "SL2"],
+            "age": ["AT1", "SL2"],
+        }
+        expected_params = dict(
+            expected_params,
+            Key="snapshots/orderings.json.gz",
+            Body=snapshot_body(orderings),
+        )
+        stub.add_response("put_object", {}, expected_params)
+
+        # contentHash is only for the sync
+        pet_sync.publish_snapshot([dict(socks, contentHash="abc"), fido], 3)
+
+        stub.assert_no_pending_responses()
+
+
+def test_put_snapshot_brotli_variant(monkeypatch):
+    monkeypatch.setattr(
+        pet_sync, "brotli", SimpleNamespace(compress=lambda body: b"br:" + body)
+    )
+    pets = [{"id": "SL1"}]
+    metadata = {"sync-version": "3", "generated-at": "0"}
+
+    with Stubber(pet_sync.s3_client) as stub:
+        expected_params = {
+            "Bucket": "dpa-api-catalog",
+            "Key": "snapshots/pets.json.gz",
+            "Body": snapshot_body(pets),
+            "ContentType": "application/json",
+            "ContentEncoding": "gzip",
+            "Metadata": metadata,
+        }
+        stub.add_response("put_object", {}, expected_params)
+        expected_params = dict(
+            expected_params,
+            Key="snapshots/pets.json.br",
+            Body=b'br:[{"id":"SL1"}]',
+            ContentEncoding="br",
+        )
+        stub.add_response("put_object", {}, expected_params)
+
+        pet_sync.put_snapshot(
+            "snapshots/pets.json.gz", pets, metadata, brotli_variant=True
+        )
+
+        # search indexes and orderings are only read by the API itself
+        stub.add_response("put_object", {}, None)
+        pet_sync.put_snapshot("snapshots/orderings.json.gz", {}, metadata)
+
+        stub.assert_no_pending_responses()
+
+
+def test_add_content_hashes():
+    pets = {
+        "AT1": {"id": "AT1", "name": "Fido"},
+        "AT2": {"id": "AT2", "name": "Petey"},
+    }
+    pet_sync.add_content_hashes(pets)
+
+    first_hash = pets["AT1"]["contentHash"]
+    assert first_hash != pets["AT2"]["contentHash"]
+
+    # re-hashing ignores the previous hash
+    pet_sync.add_content_hashes(pets)
+    assert pets["AT1"]["contentHash"] == first_hash
+
+    catalog = pet_sync.catalog_hash(pets)
+    pets["AT2"]["name"] = "Pete"
+    pet_sync.add_content_hashes(pets)
+    assert pet_sync.catalog_hash(pets) != catalog
+
+
+def test_add_first_seen():
+    api_pets = {
+        "SL1": {"id": "SL1", "name": "Biscuit"},
+        "SL2": {"id": "SL2", "name": "Socks"},
+    }
+    dynamodb_pets = [{"id": "SL1", "firstSeen": "2024-01-01T00:00:00Z"}]
+
+    pet_sync.add_first_seen(api_pets, dynamodb_pets)
+
+    assert api_pets["SL1"]["firstSeen"] == "2024-01-01T00:00:00Z"
+    assert api_pets["SL2"]["firstSeen"] > "2024-01-01T00:00:00Z"
+
+
+def test_build_orderings():
+    pets = [
+        {"id": "SL1", "name": "biscuit", "age": "Adult", "firstSeen": "2024-03-01"},
+        {"id": "SL2", "name": "Socks", "age": "Baby", "firstSeen": "2024-01-01"},
+        {"id": "AT3", "name": "Apollo", "age": "Senior", "firstSeen": "2024-03-01"},
+        {"id": "AT4", "name": "Zed", "age": None},
+    ]
+
+    assert pet_sync.build_orderings(pets) == {
+        "newest": ["SL1", "AT3", "SL2", "AT4"],
+        "name": ["AT3", "SL1", "SL2", "AT4"],
+        "age": ["SL2", "SL1", "AT3", "AT4"],
+    }
+
+
+def test_bump_sync_version_with_hashes():
+    hashes = {"shelterluv": "a", "airtable": "b"}
+
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        expected_params = {
+            "TableName": "PetsMeta",
+            "Key": {"id": {"S": "catalog"}},
+            "UpdateExpression": "ADD version :one SET updatedAt = :now, "
+            + "catalogHashes = :hashes, etag = :etag",
+            "ExpressionAttributeValues": {
+                ":one": {"N": "1"},
+                ":now": ANY,
+                ":hashes": {"M": {"shelterluv": {"S": "a"}, "airtable": {"S": "b"}}},
+                ":etag": {"S": pet_sync.content_hash(hashes)},
+            },
+            "ReturnValues": "UPDATED_NEW",
+        }
+        stub.add_response(
+            "update_item",
+            {"Attributes": {"version": {"N": "8"}}},
+            expected_params,
+        )
+
+        assert pet_sync.bump_sync_version(hashes) == 8
+
+        stub.assert_no_pending_responses()
+
+
+def test_build_search_index():
+    pets = [
+        {"id": "SL1", "name": "Biscuit", "breed": "Beagle", "description": None},
+        {
+            "id": "AT2",
+            "name": "Rosé",
+            "breed": "Beagles",
+            "description": "Housetrained and loves puppies",
+        },
+    ]
+
+    index = pet_sync.build_search_index(pets)
+
+    assert index["ids"] == ["SL1", "AT2"]
+    assert index["postings"]["beagle"] == [[0, 4], [1, 4]]
+    assert index["postings"]["rose"] == [[1, 8]]
+    assert index["postings"]["housetrain"] == [[1, 1]]
+    assert index["postings"]["puppy"] == [[1, 1]]
+    assert "and" not in index["postings"]
+
+
+def test_facet_counts_incremental():
+    dynamodb_pets = [
+        {"id": "SL1", "species": "dog", "size": "Small", "sex": "Male"},
+        {"id": "SL2", "species": "cat", "size": "Small", "sex": "Female"},
+        {"id": "SL3", "species": "dog", "size": "Large", "sex": "Female"},
+    ]
+    api_pets = {
+        "SL1": {"id": "SL1", "species": "dog", "size": "Small", "sex": "Male"},
+        "SL3": {"id": "SL3", "species": "dog", "size": "Medium", "sex": "Female"},
+        "SL4": {"id": "SL4", "species": "rabbit", "size": "Small", "sex": "Male"},
+    }
+    pet_sync.add_content_hashes(api_pets)
+    facets = pet_sync.FacetCounts.from_pets(dynamodb_pets)
+
+    with Stubber(pet_sync.pets_table.meta.client) as stub:
+        stub.add_response("batch_write_item", {"UnprocessedItems": {}}, None)
+        pet_sync.update_pets(api_pets, dynamodb_pets, facets)
+
+    assert facets.total() == 3
+    assert facets.data == pet_sync.FacetCounts.from_pets(list(api_pets.values())).data
+    assert facets.data["all"]["species"] == {"dog": 2, "rabbit": 1}
+    assert facets.data["species"]["dog"]["size"] == {"Small": 1, "Medium": 1}
+    assert "cat" not in facets.data["species"]
+
+
+def test_facet_counts_untouched_by_failed_write():
+    dynamodb_pets = [{"id": "SL1", "species": "dog", "contentHash": "x"}]
+    api_pets = {"SL2": {"id": "SL2", "species": "cat"}}
+    pet_sync.add_content_hashes(api_pets)
+    facets = pet_sync.FacetCounts.from_pets(dynamodb_pets)
+
+    with Stubber(pet_sync.pets_table.meta.client) as stub:
+        stub.add_client_error("batch_write_item")
+
+        with pytest.raises(exceptions.ClientError):
+            pet_sync.update_pets(api_pets, dynamodb_pets, facets)
+
+    assert facets.data == pet_sync.FacetCounts.from_pets(dynamodb_pets).data
+
+
+def test_update_pets_writes_only_changes():
+    api_pets = {
+        "SL1": {"id": "SL1", "name": "Biscuit"},
+        "SL2": {"id": "SL2", "name": "Socks"},
+        "SL4": {"id": "SL4", "name": "Pepper"},
+    }
+    pet_sync.add_content_hashes(api_pets)
+    dynamodb_pets = [
+        {"id": "SL1", "contentHash": api_pets["SL1"]["contentHash"]},
+        {"id": "SL2", "contentHash": "stale"},
+        {"id": "SL3", "contentHash": "gone"},
+    ]
+
+    with Stubber(pet_sync.pets_table.meta.client) as stub:
+        expected_params = {
+            "RequestItems": {
+                "Pets": [
+                    {"DeleteRequest": {"Key": {"id": "SL3"}}},
+                    {"PutRequest": {"Item": api_pets["SL4"]}},
+                    {"PutRequest": {"Item": api_pets["SL2"]}},
+                ]
+            }
+        }
+        stub.add_response("batch_write_item", {"UnprocessedItems": {}}, expected_params)
+
+        counts = pet_sync.update_pets(api_pets, dynamodb_pets)
+
+        stub.assert_no_pending_responses()
+
+    assert counts == {"added": 1, "changed": 1, "removed": 1, "unchanged": 1}
+
+
+def test_update_pets_nothing_changed():
+    api_pets = {"SL1": {"id": "SL1", "name": "Biscuit"}}
+    pet_sync.add_content_hashes(api_pets)
+    dynamodb_pets = [{"id": "SL1", "contentHash": api_pets["SL1"]["contentHash"]}]
+
+    # no writes at all
+    with Stubber(pet_sync.pets_table.meta.client) as stub:
+        counts = pet_sync.update_pets(api_pets, dynamodb_pets)
+        stub.assert_no_pending_responses()
+
+    assert counts == {"added": 0, "changed": 0, "removed": 0, "unchanged": 1}
+
+
+def test_save_facets():
+    facets = pet_sync.FacetCounts.from_pets([{"id": "SL1", "species": "dog"}])
+    document = json.dumps(facets.data, separators=(",", ":"))
+
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        stub.add_response(
+            "put_item",
+            {},
+            {
+                "TableName": "PetsMeta",
+                "Item": {
+                    "id": {"S": "facets"},
+                    "facets": {"S": document},
+                    "version": {"N": "3"},
+                },
+            },
+        )
+
+        pet_sync.save_facets(facets, 3)
+
+        stub.assert_no_pending_responses()
@@ -128,3 +128,59 @@ def test_get_pets_none_found():
         assert pet_sync.get_pets() == None
 
         stub.assert_no_pending_responses()
+
+
+def test_get_pets_parallel_scan(monkeypatch):
+    monkeypatch.setattr(pet_sync, "scan_segments", 2)
+    # a single worker keeps the stubbed responses in segment order
+    monkeypatch.setattr(pet_sync, "scan_max_workers", 1)
+
+    with Stubber(pet_sync.dynamodb_client) as stub:
+        stub.add_response(
+            "scan",
+            {
+                "Items": [{"source": {"S": "shelterluv"}, "name": {"S": "Socks"}}],
+                "LastEvaluatedKey": {"name": {"S": "Socks"}},
+            },
+            {
+                "TableName": "Pets",
+                "IndexName": "SyncIndex",
+                "Segment": 0,
+                "TotalSegments": 2,
+            },
+        )
+        stub.add_response(
+            "scan",
+            {"Items": [{"source": {"S": "airtable"}, "name": {"S": "Fido"}}]},
+            {
+                "TableName": "Pets",
+                "IndexName": "SyncIndex",
+                "Segment": 0,
+                "TotalSegments": 2,
+                "ExclusiveStartKey": {"name": {"S": "Socks"}},
+            },
+        )
+        stub.add_response(
+            "scan",
+            {"Items": [{"source": {"S": "shelterluv"}, "name": {"S": "Joey"}}]},
+            {
+                "TableName": "Pets",
+                "IndexName": "SyncIndex",
+                "Segment": 1,
+                "TotalSegments": 2,
+            },
+        )
+
+        pets = pet_sync.get_pets()
+
+        stub.assert_no_pending_responses()
+
+        assert pets == {
+            "shelterluv": [
+                {"source": "shelterluv", "name": "Socks"},
+                {"source": "shelterluv", "name": "Joey"},
+            ],
+            "airtable": [
+                {"source": "airtable", "name": "Fido"},
+            ],
+        }
@@ -0,0 +1,171 @@
+import pytest
+
+from ..src import pet_sync
+
+
+@pytest.fixture
+def sync(monkeypatch):
+    calls = {"published": [], "facets": [], "versions": [], "airtable_state": []}
+    calls["order"] = []
+    current_pets = {
+        "shelterluv": [{"id": "SL1", "species": "dog", "contentHash": "x"}],
+        "airtable": [],
+    }
+    calls["current_pets"] = current_pets
+
+    def bump_sync_version(hashes):
+        calls["versions"].append(hashes)
+        calls["order"].append(("bump", 5))
+        return 5
+
+    def publish_snapshot(pets, version):
+        calls["published"].append(pets)
+        calls["order"].append(("publish", version))
+
+    monkeypatch.setattr(pet_sync, "get_pets", lambda: current_pets)
+    monkeypatch.setattr(pet_sync, "update_pets", fake_update_pets)
+    monkeypatch.setattr(pet_sync, "bump_sync_version", bump_sync_version)
+    monkeypatch.setattr(
+        pet_sync, "save_facets", lambda facets, _: calls["facets"].append(facets)
+    )
+    monkeypatch.setattr(pet_sync, "publish_snapshot", publish_snapshot)
+    monkeypatch.setattr(pet_sync, "read_sync_version", lambda: 4)
+    monkeypatch.setattr(pet_sync, "load_airtable_state", lambda: None)
+    monkeypatch.setattr(
+        pet_sync,
+        "save_airtable_state",
+        lambda *state: calls["airtable_state"].append(state),
+    )
+    monkeypatch.setattr(
+        pet_sync,
+        "parse_shelterluv_pets",
+        lambda _: {"SL1": {"id": "SL1", "species": "dog"}},
+    )
+    monkeypatch.setattr(
+        pet_sync,
+        "parse_new_digs_pets",
+        lambda _: {"AT2": {"id": "AT2", "species": "cat"}},
+    )
+    return calls
+
+
+def fake_update_pets(api_pets, dynamodb_pets, facets):
+    existing = {pet["id"] for pet in dynamodb_pets}
+    for pet in api_pets.values():
+        if pet["id"] not in existing:
+            facets.add(pet)
+    added = len(api_pets.keys() - existing)
+    return {"added": added, "changed": 0, "removed": 0, "unchanged": 0}
+
+
+def test_handler(monkeypatch, sync):
+    monkeypatch.setattr(pet_sync, "get_shelterluv_pets", lambda: {})
+    monkeypatch.setattr(pet_sync, "get_new_digs_pets", lambda _: [])
+
+    summary = pet_sync.handler(None, None)
+
+    assert summary["version"] == 5
+    assert summary["sources"]["shelterluv"]["status"] == "ok"
+    assert summary["sources"]["airtable"] == {
+        "status": "ok",
+        "added": 1,
+        "changed": 0,
+        "removed": 0,
+        "unchanged": 0,
+    }
+
+    assert set(sync["versions"][0]) == {"shelterluv", "airtable"}
+    assert [pet["id"] for pet in sync["published"][0]] == ["SL1", "AT2"]
+    assert sync["facets"][0].total() == 2
+    assert len(sync["airtable_state"]) == 1
+    # published for the next version before the marker moves to it
+    assert sync["order"] == [("publish", 5), ("bump", 5)]
+
+
+def test_handler_source_failure_is_isolated(monkeypatch, sync):
+    def fail():
+        raise ValueError("Invalid response code from Shelterluv")
+
+    monkeypatch.setattr(pet_sync, "get_shelterluv_pets", fail)
+    monkeypatch.setattr(pet_sync, "get_new_digs_pets", lambda _: [])
+
+    summary = pet_sync.handler(None, None)
+
+    assert summary["sources"]["shelterluv"]["status"] == "failed"
+    assert "Shelterluv" in summary["sources"]["shelterluv"]["error"]
+    assert summary["sources"]["airtable"]["status"] == "ok"
+
+    # the version still moves on for airtable's writes, with an etag that
+    # can't match anything cached
+    hashes = sync["versions"][0]
+    assert hashes["shelterluv"].startswith("failed:")
+    assert not hashes["airtable"].startswith("failed:")
+
+    # incomplete catalogs aren't published, the facets still cover
+    # airtable's writes
+    assert sync["published"] == []
+    assert sync["facets"][0].total() == 2
+
+
+def test_handler_every_source_failed(monkeypatch, sync):
+    def fail(*_):
+        raise ValueError("down")
+
+    monkeypatch.setattr(pet_sync, "get_shelterluv_pets", fail)
+    monkeypatch.setattr(pet_sync, "get_new_digs_pets", fail)
+
+    with pytest.raises(RuntimeError):
+        pet_sync.handler(None, None)
+
+    assert sync["versions"] == []
+    assert sync["airtable_state"] == []
+
+
+def test_handler_counts_facets_from_the_table(monkeypatch, sync):
+    monkeypatch.setattr(pet_sync, "get_shelterluv_pets", lambda: {})
+    monkeypatch.setattr(pet_sync, "get_new_digs_pets", lambda _: [])
+    # written by an earlier run whose facet document never got saved
+    sync["current_pets"]["shelterluv"][0]["age"] = "Adult"
+
+    pet_sync.handler(None, None)
+
+    assert sync["facets"][0].data["all"]["age"] == {"Adult": 1}
+
+
+def test_handler_recovers_after_a_failed_source(monkeypatch, sync):
+    def fail():
+        raise ValueError("Invalid response code from Shelterluv")
+
+    monkeypatch.setattr(pet_sync, "get_shelterluv_pets", fail)
+    monkeypatch.setattr(pet_sync, "get_new_digs_pets", lambda _: [])
+    pet_sync.handler(None, None)
+
+    # airtable's pet is in the table by the next run, and a shelterluv pet
+    # changed age group in between
+    sync["current_pets"]["airtable"].append(
+        {"id": "AT2", "species": "cat", "contentHash": "y"}
+    )
+    sync["current_pets"]["shelterluv"][0]["age"] = "Senior"
+    monkeypatch.setattr(pet_sync, "get_shelterluv_pets", lambda: {})
+    summary = pet_sync.handler(None, None)
+
+    assert summary["sources"]["shelterluv"]["status"] == "ok"
+    facets = sync["facets"][-1]
+    assert facets.total() == 2
+    assert facets.data["all"]["age"] == {"Senior": 1}
+    assert [pet["id"] for pet in sync["published"][0]] == ["SL1", "AT2"]
+
+
+def test_handler_bumps_version_when_publish_fails(monkeypatch, sync):
+    def fail(pets, version):
+        raise ValueError("S3 is down")
+
+    monkeypatch.setattr(pet_sync, "get_shelterluv_pets", lambda: {})
+    monkeypatch.setattr(pet_sync, "get_new_digs_pets", lambda _: [])
+    monkeypatch.setattr(pet_sync, "publish_snapshot", fail)
+
+    with pytest.raises(ValueError):
+        pet_sync.handler(None, None)
+
+    # the pets were written, so cached responses still have to go
+    assert len(sync["versions"]) == 1
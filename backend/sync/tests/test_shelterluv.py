@@ -11,6 +11,21 @@ from ..src import pet_sync
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
 
+def stub_secrets(stub, api_key="abc"):
+    stub.add_response(
+        "batch_get_secret_value",
+        {
+            "SecretValues": [
+                {"Name": "shelterluv_api_key", "SecretString": api_key},
+                {"Name": "airtable_personal_access_token", "SecretString": "token"},
+                {"Name": "airtable_base", "SecretString": "base"},
+            ],
+            "Errors": [],
+        },
+        {"SecretIdList": list(pet_sync.sync_secrets)},
+    )
+
+
 def test_get_shelterluv_pets():
 
     sample_pets = None
@@ -20,10 +35,7 @@ def test_get_shelterluv_pets():
         sample_pets = f.read()
 
     with Stubber(pet_sync.secrets_client) as stub:
-        expected_params = {
-            "SecretId": "shelterluv_api_key",
-        }
-        stub.add_response("get_secret_value", {"SecretString": "abc"}, expected_params)
+        stub_secrets(stub)
 
         with requests_mock.Mocker() as requests_mocker:
             requests_mocker.get(
@@ -47,13 +59,118 @@ def test_get_shelterluv_pets():
     }
 
 
-def test_get_shelterluv_pets_bad_response():
+def test_get_shelterluv_pets_concurrent_pages():
+    def page(ids, has_more):
+        animals = [{"ID": id} for id in ids]
+        return {
+            "success": 1,
+            "animals": animals,
+            "has_more": has_more,
+            "total_count": "250",
+        }
+
+    url = "https://www.shelterluv.com/api/v1/animals?status_type=publishable&offset="
+    first = [str(n) for n in range(100)]
+    # a pet that moved between pages shows up twice
+    second = [str(n) for n in range(99, 199)]
+    third = [str(n) for n in range(199, 251)]
 
     with Stubber(pet_sync.secrets_client) as stub:
-        expected_params = {
-            "SecretId": "shelterluv_api_key",
+        stub_secrets(stub)
+
+        with requests_mock.Mocker() as requests_mocker:
+            requests_mocker.get(url + "0", json=page(first, True))
+            requests_mocker.get(url + "100", json=page(second, True))
+            requests_mocker.get(url + "200", json=page(third, False))
+
+            pets = pet_sync.get_shelterluv_pets()
+
+            assert requests_mocker.call_count == 3
+            assert all(
+                request.headers["x-api-key"] == "abc"
+                for request in requests_mocker.request_history
+            )
+
+    assert list(pets) == [str(n) for n in range(251)]
+
+
+def test_get_shelterluv_pets_more_than_total_count():
+    def page(ids, has_more):
+        animals = [{"ID": id} for id in ids]
+        return {
+            "success": 1,
+            "animals": animals,
+            "has_more": has_more,
+            "total_count": "150",
         }
-        stub.add_response("get_secret_value", {"SecretString": "abc"}, expected_params)
+
+    url = "https://www.shelterluv.com/api/v1/animals?status_type=publishable&offset="
+
+    with Stubber(pet_sync.secrets_client) as stub:
+        stub_secrets(stub)
+
+        with requests_mock.Mocker() as requests_mocker:
+            requests_mocker.get(url + "0", json=page(range(100), True))
+            # more animals were published after the first page was read
+            requests_mocker.get(url + "100", json=page(range(100, 200), True))
+            requests_mocker.get(url + "200", json=page(range(200, 210), False))
+
+            pets = pet_sync.get_shelterluv_pets()
+
+            assert requests_mocker.call_count == 3
+
+    assert len(pets) == 210
+
+
+def test_secrets_are_cached(monkeypatch):
+    with Stubber(pet_sync.secrets_client) as stub:
+        stub_secrets(stub)
+        assert pet_sync.get_secrets()["airtable_base"] == "base"
+        # a warm invocation doesn't fetch them again
+        assert pet_sync.get_secrets()["shelterluv_api_key"] == "abc"
+        stub.assert_no_pending_responses()
+
+        monkeypatch.setattr(pet_sync, "secrets_ttl_seconds", 0)
+        stub_secrets(stub, "def")
+        assert pet_sync.get_secrets()["shelterluv_api_key"] == "def"
+        stub.assert_no_pending_responses()
+
+
+def test_get_shelterluv_pets_rotated_key():
+    url = "https://www.shelterluv.com/api/v1/animals?status_type=publishable&offset=0"
+
+    def respond(request, context):
+        if request.headers["x-api-key"] != "new":
+            context.status_code = 401
+            return {}
+        return {
+            "success": 1,
+            "animals": [{"ID": "1"}],
+            "has_more": False,
+            "total_count": "1",
+        }
+
+    with Stubber(pet_sync.secrets_client) as stub:
+        stub_secrets(stub, "old")
+        stub_secrets(stub, "new")
+
+        with requests_mock.Mocker() as requests_mocker:
+            requests_mocker.get(url, json=respond)
+            pets = pet_sync.get_shelterluv_pets()
+
+            assert requests_mocker.call_count == 2
+
+        stub.assert_no_pending_responses()
+
+    assert list(pets) == ["1"]
+    # the same session serves later runs
+    assert pet_sync.http_session("shelterluv") is pet_sync.http_session("shelterluv")
+
+
+def test_get_shelterluv_pets_bad_response():
+
+    with Stubber(pet_sync.secrets_client) as stub:
+        stub_secrets(stub)
 
         with requests_mock.Mocker() as requests_mocker:
             requests_mocker.get(
@@ -80,10 +197,7 @@ def test_get_shelterluv_pets_not_success():
     sample_pets = json.dumps(sample_pets)
 
     with Stubber(pet_sync.secrets_client) as stub:
-        expected_params = {
-            "SecretId": "shelterluv_api_key",
-        }
-        stub.add_response("get_secret_value", {"SecretString": "abc"}, expected_params)
+        stub_secrets(stub)
 
         with requests_mock.Mocker() as requests_mocker:
             requests_mocker.get(
@@ -110,10 +224,7 @@ def test_get_shelterluv_pets_no_animals():
     sample_pets = json.dumps(sample_pets)
 
     with Stubber(pet_sync.secrets_client) as stub:
-        expected_params = {
-            "SecretId": "shelterluv_api_key",
-        }
-        stub.add_response("get_secret_value", {"SecretString": "abc"}, expected_params)
+        stub_secrets(stub)
 
         with requests_mock.Mocker() as requests_mocker:
             requests_mocker.get(
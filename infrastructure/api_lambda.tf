@@ -36,6 +36,20 @@ resource "aws_lambda_function" "dpa_api_lambda" {
   ]
 
   timeout = 15
+
+  environment {
+    variables = {
+      PETS_SCAN_SEGMENTS = "4"
+      PETS_CURSOR_SECRET = random_password.cursor_secret.result
+      # "1" adds Server-Timing headers and CloudWatch embedded metric logs
+      PETS_METRICS = "0"
+    }
+  }
+}
+
+resource "random_password" "cursor_secret" {
+  length  = 48
+  special = false
 }
 
 resource "aws_cloudwatch_log_group" "dpa_api_lambda_log_group" {
@@ -71,6 +85,7 @@ resource "aws_iam_policy" "dynamodb_pets_get_list" {
     Version = "2012-10-17"
     Statement = [{
       Action = [
+        "dynamodb:BatchGetItem",
         "dynamodb:Query",
         "dynamodb:GetItem",
         "dynamodb:Scan",
@@ -79,6 +94,7 @@ resource "aws_iam_policy" "dynamodb_pets_get_list" {
       Resource = [
         aws_dynamodb_table.pets-table.arn,
         "${aws_dynamodb_table.pets-table.arn}/index/*",
+        aws_dynamodb_table.pets-meta-table.arn,
       ]
     }]
   })
@@ -89,6 +105,42 @@ resource "aws_iam_role_policy_attachment" "db_lambda_policy" {
   policy_arn = aws_iam_policy.dynamodb_pets_get_list.arn
 }
 
+resource "aws_s3_bucket" "catalog_bucket" {
+  bucket = "dpa-api-catalog"
+}
+
+resource "aws_iam_policy" "catalog_snapshot_read" {
+  name = "catalog_snapshot_read"
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Action = [
+        "s3:GetObject",
+      ]
+      Effect = "Allow"
+      Resource = [
+        "${aws_s3_bucket.catalog_bucket.arn}/*",
+      ]
+      }, {
+      # without it S3 answers AccessDenied instead of NoSuchKey for
+      # snapshots that haven't been published
+      Action = [
+        "s3:ListBucket",
+      ]
+      Effect = "Allow"
+      # no s3:prefix condition, a GetObject doesn't carry that key
+      Resource = [
+        aws_s3_bucket.catalog_bucket.arn,
+      ]
+    }]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "catalog_read_lambda_policy" {
+  role       = aws_iam_role.api_lambda_exec.name
+  policy_arn = aws_iam_policy.catalog_snapshot_read.arn
+}
+
 data "archive_file" "lambda_layer" {
   type = "zip"
 
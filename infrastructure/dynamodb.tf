@@ -28,6 +28,17 @@ resource "aws_dynamodb_table" "pets-table" {
     name               = "SyncIndex"
     hash_key           = "internalId"
     projection_type    = "INCLUDE"
-    non_key_attributes = ["source"]
+    non_key_attributes = ["source", "contentHash", "firstSeen", "species", "size", "age", "sex", "location"]
+  }
+}
+
+resource "aws_dynamodb_table" "pets-meta-table" {
+  name           = "PetsMeta"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "id"
+
+  attribute {
+    name = "id"
+    type = "S"
   }
 }
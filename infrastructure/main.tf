@@ -8,6 +8,10 @@ terraform {
       source  = "hashicorp/archive"
       version = "~> 2.2.0"
     }
+    random = {
+      source  = "hashicorp/random"
+      version = "~> 3.4.0"
+    }
   }
 
   backend "s3" {
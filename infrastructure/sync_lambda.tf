@@ -41,17 +41,20 @@ resource "aws_iam_policy" "dynamodb_pets_sync" {
     Version = "2012-10-17"
     Statement = [{
       Action = [
+        "dynamodb:BatchGetItem",
         "dynamodb:BatchWriteItem",
         "dynamodb:DeleteItem",
         "dynamodb:GetItem",
         "dynamodb:PutItem",
         "dynamodb:Query",
         "dynamodb:Scan",
+        "dynamodb:UpdateItem",
       ]
       Effect = "Allow"
       Resource = [
         aws_dynamodb_table.pets-table.arn,
         "${aws_dynamodb_table.pets-table.arn}/index/*",
+        aws_dynamodb_table.pets-meta-table.arn,
       ]
     }]
   })
@@ -62,6 +65,27 @@ resource "aws_iam_role_policy_attachment" "db_sync_lambda_policy" {
   policy_arn = aws_iam_policy.dynamodb_pets_sync.arn
 }
 
+resource "aws_iam_policy" "catalog_snapshot_write" {
+  name = "catalog_snapshot_write"
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Action = [
+        "s3:PutObject",
+      ]
+      Effect = "Allow"
+      Resource = [
+        "${aws_s3_bucket.catalog_bucket.arn}/*",
+      ]
+    }]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "catalog_write_lambda_policy" {
+  role       = aws_iam_role.sync_lambda_exec.name
+  policy_arn = aws_iam_policy.catalog_snapshot_write.arn
+}
+
 resource "aws_iam_policy" "api_sync_get_shelterluv_api_key" {
   name = "api_sync_get_shelterluv_api_key"
   policy = jsonencode({
@@ -76,6 +100,14 @@ resource "aws_iam_policy" "api_sync_get_shelterluv_api_key" {
         aws_secretsmanager_secret.airtable_base.arn,
         aws_secretsmanager_secret.shelterluv_api_key.arn,
       ]
+      }, {
+      # BatchGetSecretValue can't be scoped to secrets, GetSecretValue
+      # above still limits what it returns
+      Action = [
+        "secretsmanager:BatchGetSecretValue",
+      ]
+      Effect   = "Allow"
+      Resource = "*"
     }]
   })
 }
@@ -103,6 +135,12 @@ resource "aws_lambda_function" "dpa_api_lambda_sync" {
   ]
 
   timeout = 30
+
+  environment {
+    variables = {
+      PETS_SCAN_SEGMENTS = "4"
+    }
+  }
 }
 
 resource "aws_cloudwatch_log_group" "dpa_api_lambda_sync_log_group" {